@@ -0,0 +1,134 @@
+import numpy as np
+
+import scoring
+from board import BLOB_HEADER, Board
+from scoring import BLACK, EMPTY, WHITE
+
+# every function takes boards as an (N, size, size) int8 array of EMPTY, BLACK and WHITE like Board.board_array
+
+
+def stack(boards):
+    return np.stack([board.board_array for board in boards])
+
+
+def from_blobs(blobs):
+    # positions stored by Board.to_bytes, all of one size, with the prisoners each side has taken
+    size = BLOB_HEADER.unpack_from(blobs[0])[0]
+    boards = np.empty((len(blobs), size, size), dtype=np.int8)
+    black_prisoners = np.empty(len(blobs), dtype=np.int32)
+    white_prisoners = np.empty(len(blobs), dtype=np.int32)
+    for i, blob in enumerate(blobs):
+        header = BLOB_HEADER.unpack_from(blob)
+        if header[0] != size:
+            raise ValueError(f"Can't stack a {header[0]}x{header[0]} board with {size}x{size} ones")
+        boards[i] = np.frombuffer(blob, dtype=np.int8, count=size * size, offset=BLOB_HEADER.size).reshape(size, size)
+        black_prisoners[i] = header[2]
+        white_prisoners[i] = header[3]
+    return boards, black_prisoners, white_prisoners
+
+
+def pad(boards, value=Board.BORDER):
+    return np.pad(boards, ((0, 0), (1, 1), (1, 1)), constant_values=value)
+
+
+def groups(boards):
+    # labels of the groups of all boards, unique over the whole stack, and the colour of every label
+    black, black_count = scoring.label_regions(boards == BLACK)
+    white, white_count = scoring.label_regions(boards == WHITE)
+    labels = black + np.where(white > 0, white + black_count, 0)
+    colors = np.concatenate(([EMPTY], np.full(black_count, BLACK), np.full(white_count, WHITE))).astype(np.int8)
+    return labels, colors
+
+
+def liberties(boards, labels=None):
+    # liberties of every label, an empty point next to a group twice still counts once
+    if labels is None:
+        labels, _ = groups(boards)
+    count = labels.max() + 1
+    empty = (boards == EMPTY).ravel()
+    points = np.arange(boards.size).reshape(boards.shape)
+    pairs = []
+    for side in scoring.neighbours(pad(labels, 0)):
+        touching = empty & (side.ravel() > 0)
+        pairs.append(side.ravel()[touching].astype(np.int64) * boards.size + points.ravel()[touching])
+    pairs = np.unique(np.concatenate(pairs))
+    return np.bincount(pairs // boards.size, minlength=count)
+
+
+def has_liberties(boards, labels, count):
+    # cheaper than counting them when only captures matter
+    empty = boards == EMPTY
+    free = np.zeros(count, dtype=bool)
+    for side in scoring.neighbours(pad(labels, 0)):
+        free[side[empty]] = True
+    free[0] = False
+    return free
+
+
+def territory(boards):
+    return scoring.territory(pad(boards))
+
+
+def score(boards, black_prisoners=0, white_prisoners=0, rules=scoring.TERRITORY, komi=0, owners=None):
+    if owners is None:
+        owners = territory(boards)
+    black = np.count_nonzero(owners == BLACK, axis=(1, 2))
+    white = np.count_nonzero(owners == WHITE, axis=(1, 2))
+    if rules == scoring.AREA:
+        black += np.count_nonzero(boards == BLACK, axis=(1, 2))
+        white += np.count_nonzero(boards == WHITE, axis=(1, 2))
+    elif rules == scoring.TERRITORY:
+        black = black + black_prisoners
+        white = white + white_prisoners
+    else:
+        raise ValueError(f"Unknown scoring rules {rules}")
+    return black, white + komi
+
+
+def play(boards, rows, columns, colors):
+    # one move on every board, returns the new boards, the stones each move captured and which moves were legal.
+    # Moves on taken points and suicides are illegal and leave their board as it was, ko is not checked.
+    n = len(boards)
+    index = np.arange(n)
+    rows = np.asarray(rows)
+    columns = np.asarray(columns)
+    colors = np.broadcast_to(np.asarray(colors, dtype=np.int8), (n,))
+    legal = boards[index, rows, columns] == EMPTY
+    played = boards.copy()
+    played[index[legal], rows[legal], columns[legal]] = colors[legal]
+
+    labels, label_colors = groups(played)
+    free = has_liberties(played, labels, len(label_colors))
+    padded = pad(labels, 0)
+    around = np.stack([padded[index, rows, columns + 1], padded[index, rows + 2, columns + 1],
+                       padded[index, rows + 1, columns], padded[index, rows + 1, columns + 2]], axis=1)
+    opponent = np.where(colors == BLACK, WHITE, BLACK)[:, np.newaxis]
+    taken = (around > 0) & (label_colors[around] == opponent) & ~free[around] & legal[:, np.newaxis]
+    captured_labels = np.zeros(len(label_colors), dtype=bool)
+    captured_labels[around[taken]] = True
+    captured = captured_labels[labels]
+    played[captured] = EMPTY
+    captures = np.count_nonzero(captured, axis=(1, 2))
+
+    own = labels[index, rows, columns]
+    suicide = legal & (captures == 0) & ~free[own]
+    played[suicide] = boards[suicide]
+    return played, captures, legal & ~suicide
+
+
+class BoardAnalysis:
+    def __init__(self, boards):
+        self.boards = boards
+        self.labels, self.label_colors = groups(boards)
+        self.label_liberties = liberties(boards, self.labels)
+        # liberties of the group on every point, 0 on empty points
+        self.liberties = np.where(self.labels > 0, self.label_liberties[self.labels], 0)
+        self.atari = self.liberties == 1
+        self.territory = territory(boards)
+
+    def score(self, black_prisoners=0, white_prisoners=0, rules=scoring.TERRITORY, komi=0):
+        return score(self.boards, black_prisoners, white_prisoners, rules, komi, self.territory)
+
+
+def analyse(boards):
+    return BoardAnalysis(np.asarray(boards, dtype=np.int8))
@@ -0,0 +1,57 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analysis
+from board import Board
+from territory_scoring import endgame_position
+
+
+def per_board(blobs):
+    scores = []
+    for blob in blobs:
+        board = Board.from_bytes(blob)
+        board.take_off_list.black = []
+        board.end_game()
+        scores.append((board.black_score, board.white_score))
+    return scores
+
+
+def batched(blobs):
+    boards, black_prisoners, white_prisoners = analysis.from_blobs(blobs)
+    result = analysis.analyse(boards)
+    black, white = result.score(black_prisoners, white_prisoners)
+    return list(zip(black.tolist(), white.tolist()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-scoring stored positions one Board at a time vs in one batch")
+    parser.add_argument("--size", type=int, default=19)
+    parser.add_argument("--positions", type=int, default=200)
+    parser.add_argument("--fill", type=float, default=0.7)
+    args = parser.parse_args()
+
+    blobs = []
+    for seed in range(args.positions):
+        board = endgame_position(args.size, seed, args.fill)
+        board.take_off_list.black = []
+        blobs.append(board.to_bytes(history=False))
+
+    start = time.perf_counter()
+    expected = per_board(blobs)
+    loop = time.perf_counter() - start
+    start = time.perf_counter()
+    scores = batched(blobs)
+    batch = time.perf_counter() - start
+    mismatches = sum(a != b for a, b in zip(expected, scores))
+    print(f"{args.positions} positions {args.size}x{args.size}")
+    print(f"per board {loop * 1e6 / args.positions:8.1f} us per position")
+    print(f"batched   {batch * 1e6 / args.positions:8.1f} us per position  speedup {loop / batch:5.2f}x  "
+          f"mismatches {mismatches}")
+
+
+if __name__ == '__main__':
+    main()
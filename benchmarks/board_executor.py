@@ -0,0 +1,77 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from board import Board
+from board_executor import INLINE, PROCESS, THREAD, BoardExecutor
+from games import Game, LiveGame
+from latency import Histogram
+from territory_scoring import endgame_position
+
+
+def rescore(board):
+    # what confirming the dead stones costs, on a copy so the position can be scored again
+    copy = Board.from_bytes(board.to_bytes())
+    copy.end_game()
+    return copy.black_score, copy.white_score
+
+
+async def heartbeat(lag, interval, stop):
+    # how late the event loop wakes up, that is how long every other update waits
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag.observe(time.perf_counter() - start - interval)
+
+
+async def player(boards, live_game, rounds):
+    for _ in range(rounds):
+        await boards.read(live_game, rescore)
+        await boards.read(live_game, Board.display)
+
+
+async def run(kind, workers, games, rounds, size):
+    boards = BoardExecutor(kind, workers)
+    boards.start()
+    live_games = []
+    for seed in range(games):
+        live_game = LiveGame(Game("bench", seed, f"game{seed}", size), "bench", seed)
+        live_game.board = endgame_position(size, seed, 0.7)
+        live_games.append(live_game)
+    lag = Histogram()
+    stop = asyncio.Event()
+    beat = asyncio.ensure_future(heartbeat(lag, 0.001, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(player(boards, live_game, rounds) for live_game in live_games))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await beat
+    boards.close()
+    return elapsed, lag, boards
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Event loop lag while many games score their boards")
+    parser.add_argument("--kinds", nargs="+", default=[INLINE, THREAD, PROCESS])
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--games", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--size", type=int, default=19)
+    args = parser.parse_args()
+
+    for kind in args.kinds:
+        elapsed, lag, boards = asyncio.get_event_loop().run_until_complete(
+            run(kind, args.workers, args.games, args.rounds, args.size))
+        print(f"{kind}: {args.games} games x {args.rounds} rounds in {elapsed:.2f} s")
+        print(f"loop lag {lag.summary()}")
+        print(lag.display())
+        print(boards.report())
+        print()
+
+
+if __name__ == '__main__':
+    main()
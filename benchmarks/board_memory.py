@@ -0,0 +1,49 @@
+import argparse
+import os
+import string
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from board import Board
+from group_engine import random_game
+
+
+def notation(stone):
+    return f"{string.ascii_lowercase[stone[0]]}{stone[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory and move throughput of many concurrent boards")
+    parser.add_argument("--size", type=int, default=19)
+    parser.add_argument("--boards", type=int, default=1000)
+    parser.add_argument("--moves", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    games = [[notation(stone) for stone in random_game(args.size, args.seed + i)][:args.moves] for i in range(10)]
+
+    tracemalloc.start()
+    boards = []
+    played = 0
+    start = time.perf_counter()
+    for i in range(args.boards):
+        board = Board(args.size)
+        for move in games[i % len(games)]:
+            if board.make_move(move) == board.PLACE_TAKEN:
+                board.passing()
+            played += 1
+        boards.append(board)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{args.boards} boards of {args.size}x{args.size} after {args.moves} moves")
+    print(f"memory:    {current / args.boards / 1024:8.1f} KiB/board")
+    print(f"make_move: {elapsed / played * 1e6:8.1f} us/move (traced)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from string import ascii_lowercase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+import board_image
+from board import Board, SIZES
+from flood_fill import snake_board
+from territory_scoring import endgame_position
+
+# every Board operation the handlers call, on each board size and on worst-case positions.
+# Save a run with --json and pass it to --compare later, cases that got slower make the run fail.
+
+
+def notation(stone):
+    return f"{ascii_lowercase[stone[0]]}{stone[1]}"
+
+
+def legal_game(size, seed):
+    # random moves that make_move accepts, until the board is nearly full
+    rng = random.Random(seed)
+    board = Board(size)
+    moves = []
+    for _ in range(size * size):
+        rows, columns = np.nonzero(board.board_array == 0)
+        candidates = list(zip(rows.tolist(), columns.tolist()))
+        rng.shuffle(candidates)
+        for stone in candidates[:10]:
+            if board.make_move(notation(stone)) == Board.FINE:
+                moves.append(notation(stone))
+                break
+        else:
+            break
+    return moves
+
+
+def copies(board, count):
+    blob = board.to_bytes()
+    return [Board.from_bytes(blob) for _ in range(count)]
+
+
+def mass_capture(size):
+    # white fills the board but for black's first column and one point, black plays there and takes everything
+    board = Board(size)
+    for i in range(size):
+        for j in range(size):
+            board.colors[board.point((i, j))] = Board.BLACK if j == 0 else Board.WHITE
+    board.colors[board.point((size - 1, 1))] = 0
+    board.update_groups()
+    board.current_move = Board.BLACK
+    return board, notation((size - 1, 1))
+
+
+def ended(board):
+    board.end = True
+    return board
+
+
+def case_make_move(size, seed, repeat):
+    moves = legal_game(size, seed)
+    boards = [Board(size) for _ in range(repeat)]
+    start = time.perf_counter()
+    for board in boards:
+        for move in moves:
+            board.make_move(move)
+    return len(moves) * repeat, time.perf_counter() - start
+
+
+def case_mass_capture(size, seed, repeat):
+    board, move = mass_capture(size)
+    boards = copies(board, repeat)
+    start = time.perf_counter()
+    for board in boards:
+        board.make_move(move)
+    return repeat, time.perf_counter() - start
+
+
+def case_take_dead_stones(size, seed, repeat):
+    # the snake fills the board, so every group is out of liberties and goes at once
+    board = snake_board(size)
+    board.update_groups()
+    boards = copies(board, repeat)
+    start = time.perf_counter()
+    for board in boards:
+        board.take_dead_stones()
+    return repeat, time.perf_counter() - start
+
+
+def case_end_game(size, seed, repeat):
+    boards = copies(endgame_position(size, seed, 0.7), repeat)
+    start = time.perf_counter()
+    for board in boards:
+        board.end_game()
+    return repeat, time.perf_counter() - start
+
+
+def case_display_moves(size, seed, repeat):
+    # the board shown after every move of a game, only the rows a move changed are rendered again
+    moves = legal_game(size, seed)
+    elapsed = 0.0
+    for _ in range(repeat):
+        board = Board(size)
+        for move in moves:
+            board.make_move(move)
+            start = time.perf_counter()
+            board.display()
+            elapsed += time.perf_counter() - start
+    return len(moves) * repeat, elapsed
+
+
+def case_display_cold(size, seed, repeat):
+    # boards fresh from the store, nothing cached
+    boards = copies(endgame_position(size, seed, 0.7), repeat)
+    start = time.perf_counter()
+    for board in boards:
+        board.display()
+    return repeat, time.perf_counter() - start
+
+
+def case_display_cached(size, seed, repeat):
+    # the same position again, served whole from the renderer's cache
+    board = endgame_position(size, seed, 0.7)
+    board.display()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        board.display()
+    return repeat, time.perf_counter() - start
+
+
+def case_render_png(size, seed, repeat):
+    board = endgame_position(size, seed, 0.7)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        board_image.render_png(board)
+    return repeat, time.perf_counter() - start
+
+
+def case_mark_dead_stone(size, seed, repeat):
+    # every stone marked and unmarked again, whole groups are toggled each time
+    board = ended(endgame_position(size, seed, 0.7))
+    board.take_off_list.black = []
+    rows, columns = np.nonzero(board.board_array != 0)
+    moves = [notation(stone) for stone in zip(rows.tolist(), columns.tolist())]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for move in moves:
+            board.mark_dead_stone(move, Board.BLACK)
+    return len(moves) * repeat, time.perf_counter() - start
+
+
+def case_flood_fill_snake(size, seed, repeat):
+    board = snake_board(size)
+    point = board.point((0, 0))
+    start = time.perf_counter()
+    for _ in range(repeat):
+        board.flood_fill(point)
+    return repeat, time.perf_counter() - start
+
+
+CASES = {
+    "make_move": case_make_move,
+    "mass_capture": case_mass_capture,
+    "take_dead_stones_snake": case_take_dead_stones,
+    "end_game": case_end_game,
+    "display_moves": case_display_moves,
+    "display_cold": case_display_cold,
+    "display_cached": case_display_cached,
+    "mark_dead_stone": case_mark_dead_stone,
+    "flood_fill_snake": case_flood_fill_snake,
+}
+# needs Pillow, like the pictures it times
+if board_image.available():
+    CASES["render_png"] = case_render_png
+
+
+def measure(name, size, seed, repeat, rounds):
+    per_op = []
+    for _ in range(rounds):
+        ops, seconds = CASES[name](size, seed, repeat)
+        per_op.append(seconds / ops)
+    return {"case": f"{name}/{size}", "ops": ops,
+            "best_us": round(min(per_op) * 1e6, 3), "median_us": round(statistics.median(per_op) * 1e6, 3)}
+
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as file:
+        baseline = {result["case"]: result for result in json.load(file)["results"]}
+    slower = []
+    for result in results:
+        before = baseline.get(result["case"], None)
+        if before is None:
+            continue
+        ratio = result["best_us"] / before["best_us"]
+        marker = "  SLOWER" if ratio > threshold else ""
+        print(f"{result['case']:28} {before['best_us']:10.2f} -> {result['best_us']:10.2f} us  {ratio:5.2f}x{marker}")
+        if ratio > threshold:
+            slower.append(result["case"])
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Board operation timings on every board size and worst cases")
+    parser.add_argument("--cases", nargs="+", choices=sorted(CASES), default=list(CASES))
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--repeat", type=int, default=20, help="boards or calls per round")
+    parser.add_argument("--rounds", type=int, default=5, help="the best round is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results of an earlier run, fail if a case got slower")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio that fails --compare")
+    args = parser.parse_args()
+
+    results = []
+    for name in args.cases:
+        for size in args.sizes:
+            result = measure(name, size, args.seed, args.repeat, args.rounds)
+            results.append(result)
+            print(f"{result['case']:28} {result['ops']:8} ops  best {result['best_us']:10.2f} us  "
+                  f"median {result['median_us']:10.2f} us")
+    if args.json is not None:
+        with open(args.json, "w") as file:
+            json.dump({"commit": commit(), "python": platform.python_version(), "numpy": np.__version__,
+                       "seed": args.seed, "repeat": args.repeat, "rounds": args.rounds, "results": results},
+                      file, indent=2)
+    if args.compare is not None:
+        slower = compare(results, args.compare, args.threshold)
+        if slower:
+            print(f"{len(slower)} cases slower than {args.threshold}x the baseline")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from string import ascii_lowercase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from aiogram import Bot, types
+
+import main as bot_main
+from board import Board, SIZES
+from metrics import REGISTRY
+from outbox import Outbox
+from storage import GameStore
+
+# drives the handlers of main.py with a Bot that never touches the network.
+# Needs config.py like the bot itself, but uses a database of its own.
+
+UNLIMITED = 1e9
+
+
+class FakeBot(Bot):
+    def __init__(self):
+        super().__init__(token="123456:BENCHMARK")
+        self.message_ids = itertools.count(1)
+        self.sent = 0
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        if method == "sendMessage":
+            self.sent += 1
+            return {"message_id": next(self.message_ids), "date": 0,
+                    "chat": {"id": int(data["chat_id"]), "type": "private"}, "text": data.get("text", "")}
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "GoBot", "username": "gobot"}
+        return True
+
+
+class Load:
+    def __init__(self, dp, args):
+        self.dp = dp
+        self.args = args
+        self.update_ids = itertools.count(1)
+        self.latencies = []
+
+    async def send(self, user_id, text):
+        message = {"message_id": 0, "date": 0, "chat": {"id": user_id, "type": "private"},
+                   "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}, "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        update = types.Update(update_id=next(self.update_ids), message=message)
+        start = time.perf_counter()
+        # a task per update like the executor, aiogram caches the FSM state of an update in a context variable
+        await asyncio.ensure_future(self.dp.process_update(update))
+        self.latencies.append(time.perf_counter() - start)
+
+    async def start_game(self, index, rng):
+        # the creator plays black, both players end up with the game open
+        black, white = 2 * index + 1, 2 * index + 2
+        game = f"game{index}"
+        size = rng.choice(self.args.sizes)
+        for text in ("/start", f"player{black}", "/new_game", game, "Y", str(size), "Human"):
+            await self.send(black, text)
+        for text in ("/start", f"player{white}", "/join", game):
+            await self.send(white, text)
+        for player in (black, white):
+            await self.send(player, "/play")
+            await self.send(player, game)
+        return black, white, Board(size)
+
+    async def play_moves(self, players, shadow: Board, rng):
+        # the same moves on a board of our own, so only legal ones are sent
+        turn = 0
+        for _ in range(self.args.moves):
+            player = players[turn]
+            if rng.random() < self.args.chat:
+                for text in ("/chat", f"message {rng.randrange(1000)}", "/close_chat"):
+                    await self.send(player, text)
+            rows, columns = np.nonzero(shadow.board_array == 0)
+            for _ in range(10):
+                point = rng.randrange(len(rows))
+                move = f"{ascii_lowercase[rows[point]]}{columns[point]}"
+                if shadow.make_move(move) == Board.FINE:
+                    break
+            else:
+                move = "pass"
+            if move == "pass":
+                shadow.passing()
+                await self.send(player, "/pass")
+            else:
+                for text in ("/make_move", move, "/cancel_move"):
+                    await self.send(player, text)
+            turn = 1 - turn
+        return turn
+
+    async def finish(self, players, turn):
+        await self.send(players[turn], "/pass")
+        await self.send(players[1 - turn], "/pass")
+        for player in players:
+            await self.send(player, "/take_off_confirm")
+            await self.send(player, "y")
+
+    async def game(self, index, finish=True):
+        rng = random.Random(f"{self.args.seed}:{index}")
+        black, white, shadow = await self.start_game(index, rng)
+        turn = await self.play_moves((black, white), shadow, rng)
+        if finish:
+            await self.finish((black, white), turn)
+
+
+def quantile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    bot = FakeBot()
+    Bot.set_current(bot)
+    directory = tempfile.mkdtemp(prefix="gobot-bench-")
+    store = GameStore(os.path.join(directory, "gobot.db"))
+    outbox = Outbox(bot, chat_rate=UNLIMITED, chat_burst=UNLIMITED, global_rate=UNLIMITED)
+    dp, _, on_startup, on_shutdown = bot_main.create_dispatcher(bot, store, outbox=outbox)
+    await on_startup(dp)
+
+    load = Load(dp, args)
+    start = time.perf_counter()
+    await asyncio.gather(*(load.game(index) for index in range(args.games)))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(load.latencies)
+
+    # games kept open on top of the finished ones, with allocations traced only for them
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    memory = Load(dp, args)
+    await asyncio.gather(*(memory.game(args.games + index, finish=False) for index in range(args.memory_games)))
+    gc.collect()
+    per_game = (tracemalloc.get_traced_memory()[0] - before) / args.memory_games
+    tracemalloc.stop()
+
+    if args.metrics is not None:
+        with open(args.metrics, "w") as file:
+            file.write(REGISTRY.render())
+    await on_shutdown(dp)
+    await dp.storage.close()
+    shutil.rmtree(directory)
+
+    result = {
+        "commit": commit(),
+        "seed": args.seed,
+        "games": args.games,
+        "users": 2 * args.games,
+        "moves": args.moves,
+        "updates": len(latencies),
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(quantile(latencies, 0.5) * 1000, 3),
+        "p99_ms": round(quantile(latencies, 0.99) * 1000, 3),
+        "bytes_per_active_game": round(per_game),
+        "messages_sent": bot.sent,
+    }
+    print(f"{result['updates']} updates from {result['users']} users in {elapsed:.2f} s, "
+          f"{result['updates_per_second']:.0f} updates/s")
+    print(f"handler latency p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms")
+    print(f"{per_game / 1024:.1f} KiB per active game, {bot.sent} messages sent")
+    if args.json is not None:
+        with open(args.json, "w") as file:
+            json.dump(result, file, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Whole games played through the bot's handlers without a network")
+    parser.add_argument("--games", type=int, default=500, help="games played at once, two users each")
+    parser.add_argument("--moves", type=int, default=30, help="moves per game before both players pass")
+    parser.add_argument("--chat", type=float, default=0.1, help="chance of a chat message before a move")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--memory-games", type=int, default=100, help="games left open to measure memory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file to compare runs between commits")
+    parser.add_argument("--metrics", help="write what the metrics endpoint would show at the end to this file")
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
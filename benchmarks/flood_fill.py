@@ -0,0 +1,77 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from board import Board
+
+
+def snake_board(size):
+    board = Board(size)
+    for i in range(size):
+        for j in range(size):
+            if i % 2 == 0:
+                color = board.BLACK
+            elif (i // 2) % 2 == 0:
+                color = board.BLACK if j == size - 1 else board.WHITE
+            else:
+                color = board.BLACK if j == 0 else board.WHITE
+            board.colors[board.point((i, j))] = color
+    return board
+
+
+def filled_board(size):
+    board = Board(size)
+    for i in range(size):
+        for j in range(size):
+            board.colors[board.point((i, j))] = board.BLACK
+    board.colors[board.point((size // 2, size // 2))] = 0
+    return board
+
+
+def recursive_fill(board, point, color, seen, liberties):
+    if point in seen:
+        return
+    if board.colors[point] == color:
+        seen.add(point)
+        for p in (point - board.width, point - 1, point + 1, point + board.width):
+            if board.colors[p] != board.BORDER:
+                recursive_fill(board, p, color, seen, liberties)
+    elif board.colors[point] == 0:
+        liberties.add(point)
+
+
+def time_recursive(board, point, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        recursive_fill(board, point, board.colors[point], set(), set())
+    return (time.perf_counter() - start) / repeat
+
+
+def time_iterative(board, point, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        board.flood_fill(point)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recursive vs iterative group flood fill on worst-case boards")
+    parser.add_argument("--size", type=int, default=19)
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 4 * args.size * args.size))
+    for name, board in (("snake", snake_board(args.size)), ("filled", filled_board(args.size))):
+        point = board.point((0, 0))
+        recursive = time_recursive(board, point, args.repeat)
+        iterative = time_iterative(board, point, args.repeat)
+        stones = len(board.flood_fill(point)[0])
+        print(f"{name:8} {stones:4} stones  recursive {recursive * 1e6:8.1f} us  "
+              f"iterative {iterative * 1e6:8.1f} us  speedup {recursive / iterative:5.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from board import Board
+
+
+def random_game(size, seed):
+    rng = random.Random(seed)
+    board = Board(size)
+    moves = []
+    for _ in range(size * size):
+        empties = [(i, j) for i in range(size) for j in range(size) if board.board_array[i, j] == 0]
+        if not empties:
+            break
+        stone = rng.choice(empties)
+        board.place_stone(stone, board.current_move)
+        board.current_move = board.WHITE if board.current_move == board.BLACK else board.BLACK
+        moves.append(stone)
+    return moves
+
+
+def rescan_move(board, stone, color):
+    board.board_array[stone] = color
+    board.update_groups()
+    board.take_dead_stones()
+
+
+def incremental_move(board, stone, color):
+    board.place_stone(stone, color)
+
+
+def replay(moves, size, move_function):
+    board = Board(size)
+    color = board.BLACK
+    start = time.perf_counter()
+    for stone in moves:
+        if board.board_array[stone] == 0:
+            move_function(board, stone, color)
+        color = board.WHITE if color == board.BLACK else board.BLACK
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-move cost of full rescans vs incremental group tracking")
+    parser.add_argument("--size", type=int, default=19)
+    parser.add_argument("--games", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    games = [random_game(args.size, args.seed + i) for i in range(args.games)]
+    total_moves = sum(len(moves) for moves in games)
+    rescan = sum(replay(moves, args.size, rescan_move) for moves in games)
+    incremental = sum(replay(moves, args.size, incremental_move) for moves in games)
+
+    print(f"{args.games} games on {args.size}x{args.size}, {total_moves} moves")
+    print(f"rescan:      {rescan / total_moves * 1e6:10.1f} us/move")
+    print(f"incremental: {incremental / total_moves * 1e6:10.1f} us/move")
+    print(f"speedup:     {rescan / incremental:10.1f}x")
+
+
+if __name__ == '__main__':
+    main()
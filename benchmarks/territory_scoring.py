@@ -0,0 +1,83 @@
+import argparse
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scoring
+from board import Board
+from group_engine import random_game
+
+
+def endgame_position(size, seed, fill):
+    board = Board(size)
+    color = board.BLACK
+    for stone in random_game(size, seed)[:int(size * size * fill)]:
+        if board.board_array[stone] == 0:
+            board.place_stone(stone, color)
+        color = board.WHITE if color == board.BLACK else board.BLACK
+    groups = list(board.group_dict.values())
+    for group in groups[::7]:
+        board.take_off_list.black.append(board.stone(group.stones[0]))
+    return board
+
+
+def legacy_end_game(board):
+    dead_groups = set()
+    for stone in board.take_off_list.black + board.take_off_list.white:
+        dead_groups.add(board.group_dict[board.group_ids[board.point(stone)]])
+    for group in dead_groups:
+        for point in group.stones:
+            color = board.colors[point]
+            if color == board.BLACK:
+                board.white_score += 1
+            elif color == board.WHITE:
+                board.black_score += 1
+            board.colors[point] = 0
+    board.update_groups()
+    counted = set()
+    for i in range(board.size):
+        for j in range(board.size):
+            point = board.point((i, j))
+            if board.colors[point] != 0 or point in counted:
+                continue
+            region, border = board.flood_fill(point)
+            counted.update(region)
+            neigh_colors = {board.colors[p] for p in border}
+            if len(neigh_colors) == 1:
+                color = neigh_colors.pop()
+                if color == board.BLACK:
+                    board.black_score += len(region)
+                elif color == board.WHITE:
+                    board.white_score += len(region)
+
+
+def time_scorer(positions, end_game):
+    boards = [copy.deepcopy(board) for board in positions]
+    start = time.perf_counter()
+    for board in boards:
+        end_game(board)
+    return (time.perf_counter() - start) / len(boards), [(b.black_score, b.white_score) for b in boards]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loop-based vs array-based territory scoring at the end of a game")
+    parser.add_argument("--size", type=int, default=19)
+    parser.add_argument("--positions", type=int, default=200)
+    parser.add_argument("--fill", type=float, default=0.7, help="fraction of the board's points played")
+    args = parser.parse_args()
+
+    positions = [endgame_position(args.size, seed, args.fill) for seed in range(args.positions)]
+    legacy, legacy_scores = time_scorer(positions, legacy_end_game)
+    vectorized, scores = time_scorer(positions, Board.end_game)
+    mismatches = sum(a != b for a, b in zip(legacy_scores, scores))
+    print(f"labeling with {'scipy.ndimage' if scoring.ndimage is not None else 'numpy'}")
+    print(f"legacy     {legacy * 1e6:8.1f} us per position")
+    print(f"vectorized {vectorized * 1e6:8.1f} us per position  speedup {legacy / vectorized:5.2f}x  "
+          f"mismatches {mismatches}")
+
+
+if __name__ == '__main__':
+    main()
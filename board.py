@@ -0,0 +1,644 @@
+from array import array
+from functools import lru_cache
+
+import numpy as np
+import random
+import string
+import struct
+
+import scoring
+from instruments import timed
+
+SIZES = (9, 13, 19)
+# size, current move, black score, white score, passes, end, take off flags, take off list lengths
+BLOB_HEADER = struct.Struct('<BBiiBBBBBBHH')
+# size, snapshot interval, records, snapshots
+LOG_HEADER = struct.Struct('<BHII')
+# record index, snapshot length
+SNAPSHOT_HEADER = struct.Struct('<II')
+
+
+@lru_cache(maxsize=None)
+def neighbour_table(size):
+    # on-board neighbours of every point of the padded flat layout, border points have none
+    width = size + 2
+    table = [()] * (width * width)
+    for i in range(size):
+        for j in range(size):
+            point = (i + 1) * width + j + 1
+            neighbours = []
+            if i > 0:
+                neighbours.append(point - width)
+            if j > 0:
+                neighbours.append(point - 1)
+            if i < size - 1:
+                neighbours.append(point + width)
+            if j < size - 1:
+                neighbours.append(point + 1)
+            table[point] = tuple(neighbours)
+    return tuple(table)
+
+
+@lru_cache(maxsize=None)
+def zobrist_table(size):
+    # random keys per point for (empty, black, white), seeded so hashes are stable between processes
+    width = size + 2
+    rng = random.Random(size)
+    return tuple((0, rng.getrandbits(64), rng.getrandbits(64)) for _ in range(width * width))
+
+
+@lru_cache(maxsize=None)
+def coordinates_row(size):
+    numbers = []
+    for i in range(size):
+        num = str(i)
+        numbers.append(num)
+        if i < 10:
+            numbers.append("  ")
+        numbers.append(" "*(3 - len(num)))
+    return "".join(numbers)
+
+
+for _size in SIZES:
+    neighbour_table(_size)
+    zobrist_table(_size)
+    coordinates_row(_size)
+
+
+class Board:
+    WHITE_CIRCLE = '⚪️'
+    BLACK_CIRCLE = '⚫️'
+    BROWN_CIRCLE = '🟠'
+    EMPTY = ' '
+
+    BLACK = 1
+    WHITE = 2
+    BORDER = 3
+
+    FINE = 100
+    INVALID_POSITION = 200
+    PLACE_TAKEN = 201
+    ILLEGAL_SUICIDE = 202
+    ILLEGAL_KO = 203
+    INVALID_NOTATION = 204
+    NOT_YOUR_TURN = 205
+    GAME_END = 300
+
+    def __init__(self, size):
+        self.size = size
+        self.width = size + 2
+        # colors and group ids live in flat padded buffers, the outer ring is BORDER
+        self.colors = bytearray([self.BORDER]) * (self.width * self.width)
+        for i in range(size):
+            row = (i + 1) * self.width + 1
+            self.colors[row:row + size] = bytes(size)
+        self.group_ids = array('h', bytes(2 * self.width * self.width))
+        self.neighbours = neighbour_table(size)
+        self.zobrist = zobrist_table(size)
+        self.hash = 0
+        self.history = {self.hash}
+        self.group_dict = dict()
+        self.free_group_ids = []
+        self.next_group_id = 1
+        self.current_move = Board.BLACK
+        self.black_score = 0
+        self.white_score = 0
+        self.passes = 0
+        self.end = False
+        self.take_off_list = TakeOffList()
+        self.text_renderer = TextRenderer(size)
+        self.log = MoveLog(size)
+
+    @property
+    def board_array(self):
+        return np.frombuffer(self.colors, dtype=np.int8).reshape(self.width, self.width)[1:-1, 1:-1]
+
+    @property
+    def groups_array(self):
+        return np.frombuffer(self.group_ids, dtype=np.int16).reshape(self.width, self.width)[1:-1, 1:-1]
+
+    def point(self, stone):
+        return (stone[0] + 1) * self.width + stone[1] + 1
+
+    def stone(self, point):
+        row, column = divmod(point, self.width)
+        return row - 1, column - 1
+
+    def to_bytes(self, history=True):
+        take_off = self.take_off_list
+        points = array('H', [self.point(stone) for stone in take_off.black + take_off.white])
+        header = BLOB_HEADER.pack(self.size, self.current_move, self.black_score, self.white_score,
+                                  self.passes, self.end, take_off.black_agree, take_off.white_agree,
+                                  take_off.black_ready, take_off.white_ready,
+                                  len(take_off.black), len(take_off.white))
+        blob = header + self.board_array.tobytes() + points.tobytes()
+        if history:
+            blob += array('Q', self.history).tobytes()
+        return blob
+
+    @classmethod
+    def from_bytes(cls, blob):
+        size, current_move, black_score, white_score, passes, end, black_agree, white_agree, \
+            black_ready, white_ready, black_taken, white_taken = BLOB_HEADER.unpack_from(blob)
+        board = cls(size)
+        offset = BLOB_HEADER.size
+        board.board_array[:] = np.frombuffer(blob, dtype=np.int8, count=size * size, offset=offset).reshape(size, size)
+        offset += size * size
+        points = array('H')
+        points.frombytes(blob[offset:offset + 2 * (black_taken + white_taken)])
+        offset += 2 * (black_taken + white_taken)
+        history = array('Q')
+        history.frombytes(blob[offset:])
+
+        board.update_groups()
+        board.history = set(history)
+        board.current_move = current_move
+        board.black_score = black_score
+        board.white_score = white_score
+        board.passes = passes
+        board.end = bool(end)
+        take_off = board.take_off_list
+        take_off.black = [board.stone(point) for point in points[:black_taken]]
+        take_off.white = [board.stone(point) for point in points[black_taken:]]
+        take_off.black_agree = bool(black_agree)
+        take_off.white_agree = bool(white_agree)
+        take_off.black_ready = bool(black_ready)
+        take_off.white_ready = bool(white_ready)
+        return board
+
+    @timed("gobot_board_seconds")
+    def make_move(self, move: str, color=None):
+        # with a colour the move is only played on that colour's turn
+        if color is not None and color != self.current_move:
+            return self.NOT_YOUR_TURN
+        if len(move) not in (2, 3):
+            return self.INVALID_NOTATION
+
+        letter = move[0]
+        digit = move[1:]
+        if letter not in string.ascii_lowercase:
+            return self.INVALID_NOTATION
+        if not digit.isdigit():
+            return self.INVALID_NOTATION
+        move = string.ascii_lowercase.find(letter), int(digit)
+        if move[0] >= self.size:
+            return self.INVALID_POSITION
+        if move[1] >= self.size:
+            return self.INVALID_POSITION
+        point = self.point(move)
+        if self.colors[point] != 0:
+            return self.PLACE_TAKEN
+
+        result = self.check_move(point, self.current_move)
+        if result != self.FINE:
+            return result
+        color = self.current_move
+        self.place(point, color)
+        self.history.add(self.hash)
+
+        if self.current_move == self.BLACK:
+            self.current_move = self.WHITE
+        else:
+            self.current_move = self.BLACK
+
+        self.passes = 0
+        self.log.append(self, MoveLog.PLACE, point, color)
+
+        return self.FINE
+
+    def check_move(self, point, color):
+        colors = self.colors
+        group_ids = self.group_ids
+        has_liberty = False
+        captured = []
+        for p in self.neighbours[point]:
+            neighbour_color = colors[p]
+            if neighbour_color == 0:
+                has_liberty = True
+                continue
+            neighbour = self.group_dict[group_ids[p]]
+            if neighbour_color == color:
+                if len(neighbour.liberties) > 1:
+                    has_liberty = True
+            elif len(neighbour.liberties) == 1 and neighbour not in captured:
+                captured.append(neighbour)
+        if not has_liberty and not captured:
+            return self.ILLEGAL_SUICIDE
+
+        position = self.hash ^ self.zobrist[point][color]
+        for group in captured:
+            position ^= group.hash
+        if position in self.history:
+            return self.ILLEGAL_KO
+        return self.FINE
+
+    def place_stone(self, stone, color):
+        self.place(self.point(stone), color)
+
+    def place(self, point, color):
+        colors = self.colors
+        group_ids = self.group_ids
+        group = self.new_group(color)
+        group.stones.append(point)
+        group.hash = self.zobrist[point][color]
+        colors[point] = color
+        group_ids[point] = group.group_id
+        self.hash ^= group.hash
+
+        enemies = []
+        for p in self.neighbours[point]:
+            neighbour_color = colors[p]
+            if neighbour_color == 0:
+                group.liberties.add(p)
+                continue
+            neighbour = self.group_dict[group_ids[p]]
+            neighbour.liberties.discard(point)
+            if neighbour_color == color:
+                if neighbour is not group:
+                    group = self.merge_groups(group, neighbour)
+            elif neighbour not in enemies:
+                enemies.append(neighbour)
+
+        for enemy in enemies:
+            if enemy.is_dead():
+                self.remove_group(enemy)
+        if group.is_dead():
+            self.remove_group(group)
+
+    def new_group(self, color):
+        if self.free_group_ids:
+            group_id = self.free_group_ids.pop()
+        else:
+            group_id = self.next_group_id
+            self.next_group_id += 1
+        group = Group(group_id, color)
+        self.group_dict[group_id] = group
+        return group
+
+    def drop_group(self, group):
+        del self.group_dict[group.group_id]
+        self.free_group_ids.append(group.group_id)
+
+    def merge_groups(self, first, second):
+        if len(first.stones) < len(second.stones):
+            first, second = second, first
+        group_ids = self.group_ids
+        for point in second.stones:
+            group_ids[point] = first.group_id
+        first.stones += second.stones
+        first.liberties |= second.liberties
+        first.hash ^= second.hash
+        self.drop_group(second)
+        return first
+
+    def remove_group(self, group):
+        colors = self.colors
+        group_ids = self.group_ids
+        neighbours = self.neighbours
+        if group.color == self.BLACK:
+            self.white_score += len(group.stones)
+        else:
+            self.black_score += len(group.stones)
+        for point in group.stones:
+            colors[point] = 0
+            group_ids[point] = 0
+        for point in group.stones:
+            for p in neighbours[point]:
+                if colors[p] != 0:
+                    self.group_dict[group_ids[p]].liberties.add(point)
+        self.hash ^= group.hash
+        self.drop_group(group)
+
+    @timed("gobot_board_seconds")
+    def display(self):
+        return self.text_renderer.render(self)
+
+    @timed("gobot_board_seconds")
+    def update_groups(self):
+        self.group_ids = array('h', bytes(2 * self.width * self.width))
+        self.group_dict = dict()
+        self.free_group_ids = []
+        self.next_group_id = 1
+        self.hash = 0
+        for i in range(self.size):
+            for j in range(self.size):
+                point = self.point((i, j))
+                if self.colors[point] == 0 or self.group_ids[point] != 0:
+                    continue
+                self.hash ^= self.fill_group(point).hash
+
+    def fill_group(self, point):
+        stones, border = self.flood_fill(point)
+        group = self.new_group(self.colors[point])
+        for stone in stones:
+            self.group_ids[stone] = group.group_id
+            group.hash ^= self.zobrist[stone][group.color]
+        group.stones = stones
+        group.liberties = {p for p in border if self.colors[p] == 0}
+        return group
+
+    def flood_fill(self, point):
+        colors = self.colors
+        neighbours = self.neighbours
+        color = colors[point]
+        region = [point]
+        seen = {point}
+        border = set()
+        stack = [point]
+        while stack:
+            p = stack.pop()
+            for n in neighbours[p]:
+                if n in seen:
+                    continue
+                if colors[n] == color:
+                    seen.add(n)
+                    region.append(n)
+                    stack.append(n)
+                else:
+                    border.add(n)
+        return region, border
+
+    def stone_neighbours(self, stone):
+        return [self.stone(p) for p in self.neighbours[self.point(stone)]]
+
+    def take_dead_stones(self):
+        for group in list(self.group_dict.values()):
+            if group.is_dead():
+                self.remove_group(group)
+
+    def passing(self, color=None):
+        if color is not None and color != self.current_move:
+            return self.NOT_YOUR_TURN
+        color = self.current_move
+        self.passes += 1
+        if self.passes == 2:
+            self.end = True
+            self.propose_take_off()
+            self.log.append(self, MoveLog.PASS, 0, color)
+            return self.GAME_END
+        if self.current_move == self.BLACK:
+            self.current_move = self.WHITE
+        else:
+            self.current_move = self.BLACK
+        self.log.append(self, MoveLog.PASS, 0, color)
+        return self.FINE
+
+    def mark_dead_stone(self, move, color):
+        if len(move) not in (2, 3):
+            return self.INVALID_NOTATION
+
+        letter = move[0]
+        digit = move[1:]
+
+        if not self.end:
+            raise RuntimeError("Trying to take off stones before the end of the game")
+        if letter not in string.ascii_lowercase:
+            return self.INVALID_NOTATION
+        if not digit.isdigit():
+            return self.INVALID_NOTATION
+        move = string.ascii_lowercase.find(letter), int(digit)
+        if move[0] >= self.size:
+            return self.INVALID_POSITION
+        if move[1] >= self.size:
+            return self.INVALID_POSITION
+        if self.colors[self.point(move)] != 0:
+            self.toggle_dead_group(move, color)
+            self.log.append(self, MoveLog.MARK, self.point(move), color)
+            return self.PLACE_TAKEN
+        return self.FINE
+
+    def toggle_dead_group(self, stone, color):
+        # marking a group that is already marked takes the mark back
+        marked = self.take_off_list.black if color == self.BLACK else self.take_off_list.white
+        group_id = self.group_ids[self.point(stone)]
+        kept = [s for s in marked if self.group_ids[self.point(s)] != group_id]
+        if len(kept) == len(marked):
+            kept.append(stone)
+        if color == self.BLACK:
+            self.take_off_list.black = kept
+        else:
+            self.take_off_list.white = kept
+
+    def propose_take_off(self):
+        padded = np.frombuffer(self.colors, dtype=np.int8).reshape(self.width, self.width)
+        dead = scoring.estimate_dead(padded, self.groups_array)
+        # sorted, so the proposal doesn't depend on how the groups happen to be numbered
+        stones = sorted(self.stone(min(self.group_dict[group_id].stones)) for group_id in dead)
+        self.take_off_list = TakeOffList()
+        self.take_off_list.black = list(stones)
+        self.take_off_list.white = list(stones)
+        self.take_off_list.black_ready = True
+        self.take_off_list.white_ready = True
+
+    def reset_take_off(self):
+        # a rejection keeps the marks so the players edit them instead of starting over
+        self.take_off_list.reset_agreement()
+        self.log.append(self, MoveLog.RESET_MARKS, 0, 0)
+
+    def notation(self, stone):
+        return f"{string.ascii_lowercase[stone[0]]}{stone[1]}"
+
+    @timed("gobot_board_seconds")
+    def end_game(self, rules=scoring.TERRITORY, komi=0):
+        dead_groups = set()
+        for stone in self.take_off_list.black + self.take_off_list.white:
+            group_id = self.group_ids[self.point(stone)]
+            if group_id != 0:
+                dead_groups.add(self.group_dict[group_id])
+        for group in dead_groups:
+            self.remove_group(group)
+
+        padded = np.frombuffer(self.colors, dtype=np.int8).reshape(self.width, self.width)
+        self.black_score, self.white_score = scoring.score(padded, self.black_score, self.white_score, rules, komi)
+
+
+class MoveLog:
+    PLACE = 0
+    PASS = 1
+    MARK = 2
+    RESET_MARKS = 3
+
+    SNAPSHOT_INTERVAL = 32
+
+    def __init__(self, size, snapshot_interval=SNAPSHOT_INTERVAL):
+        self.size = size
+        self.snapshot_interval = snapshot_interval
+        # one uint16 per record: kind in the top 2 bits, color in the next 2, the point below
+        self.records = array('H')
+        # position hash after each record
+        self.hashes = array('Q')
+        # (number of records applied, board blob without history)
+        self.snapshots = []
+        # records before the first one here, kept by another log, see tail
+        self.start = 0
+        # records the store has written, the ones after them go out with its next flush
+        self.saved = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def append(self, board, kind, point, color):
+        self.records.append(kind << 14 | color << 12 | point)
+        self.hashes.append(board.hash)
+        index = self.start + len(self.records)
+        if index % self.snapshot_interval == 0:
+            self.snapshots.append((index, board.to_bytes(history=False)))
+
+    def tail(self):
+        # an empty log going on from this one, a pool worker records into it without getting the whole log
+        tail = MoveLog(self.size, self.snapshot_interval)
+        tail.start = len(self.records)
+        return tail
+
+    def take_unsaved(self):
+        # the records since the last call as a log going on from the saved ones
+        unsaved = MoveLog(self.size, self.snapshot_interval)
+        unsaved.start = self.saved
+        unsaved.records = self.records[self.saved:]
+        unsaved.hashes = self.hashes[self.saved:]
+        unsaved.snapshots = [snapshot for snapshot in self.snapshots if snapshot[0] > self.saved]
+        self.saved = len(self.records)
+        return unsaved
+
+    def extend(self, tail):
+        if tail.start != len(self.records):
+            raise ValueError(f"The tail starts after {tail.start} records, the log has {len(self.records)}")
+        self.records.extend(tail.records)
+        self.hashes.extend(tail.hashes)
+        self.snapshots.extend(tail.snapshots)
+
+    @staticmethod
+    def decode(record):
+        return record >> 14, (record >> 12) & 3, record & 0xFFF
+
+    def rebuild(self, moves=None):
+        if moves is None:
+            moves = len(self.records)
+        if not 0 <= moves <= len(self.records):
+            raise IndexError(f"The log has {len(self.records)} records, can't rebuild after {moves}")
+        start = 0
+        board = Board(self.size)
+        for index, blob in reversed(self.snapshots):
+            if index <= moves:
+                start = index
+                board = Board.from_bytes(blob)
+                break
+        for record in self.records[start:moves]:
+            self.apply(board, *self.decode(record))
+
+        board.history = {0}
+        board.history.update(self.hashes[:moves])
+        log = MoveLog(self.size, self.snapshot_interval)
+        log.records = self.records[:moves]
+        log.hashes = self.hashes[:moves]
+        log.snapshots = [snapshot for snapshot in self.snapshots if snapshot[0] <= moves]
+        board.log = log
+        return board
+
+    @staticmethod
+    def apply(board, kind, color, point):
+        if kind == MoveLog.PLACE:
+            board.place(point, color)
+            board.current_move = board.WHITE if color == board.BLACK else board.BLACK
+            board.passes = 0
+        elif kind == MoveLog.PASS:
+            board.passes += 1
+            if board.passes == 2:
+                board.end = True
+                board.propose_take_off()
+            else:
+                board.current_move = board.WHITE if color == board.BLACK else board.BLACK
+        elif kind == MoveLog.MARK:
+            board.toggle_dead_group(board.stone(point), color)
+        elif kind == MoveLog.RESET_MARKS:
+            board.take_off_list.reset_agreement()
+
+    def to_bytes(self):
+        parts = [LOG_HEADER.pack(self.size, self.snapshot_interval, len(self.records), len(self.snapshots)),
+                 self.records.tobytes(), self.hashes.tobytes()]
+        for index, blob in self.snapshots:
+            parts.append(SNAPSHOT_HEADER.pack(index, len(blob)))
+            parts.append(blob)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, blob):
+        size, snapshot_interval, records, snapshots = LOG_HEADER.unpack_from(blob)
+        log = cls(size, snapshot_interval)
+        offset = LOG_HEADER.size
+        log.records.frombytes(blob[offset:offset + 2 * records])
+        offset += 2 * records
+        log.hashes.frombytes(blob[offset:offset + 8 * records])
+        offset += 8 * records
+        for _ in range(snapshots):
+            index, length = SNAPSHOT_HEADER.unpack_from(blob, offset)
+            offset += SNAPSHOT_HEADER.size
+            log.snapshots.append((index, blob[offset:offset + length]))
+            offset += length
+        return log
+
+
+class TextRenderer:
+    def __init__(self, size):
+        self.size = size
+        self.rows = [None] * size
+        self.rendered = None
+        self.rendered_hash = None
+
+    def render(self, board):
+        if self.rendered is not None and self.rendered_hash == board.hash:
+            return self.rendered
+        cell_text = (board.BROWN_CIRCLE, board.BLACK_CIRCLE, board.WHITE_CIRCLE)
+        for i in range(self.size):
+            start = (i + 1) * board.width + 1
+            cells = bytes(board.colors[start:start + self.size])
+            row = self.rows[i]
+            if row is None or row[0] != cells:
+                self.rows[i] = (cells, "".join([cell_text[cell] for cell in cells]) + string.ascii_uppercase[i])
+        result_array = [coordinates_row(self.size)]
+        result_array.extend(text for _, text in self.rows)
+        self.rendered = "\n".join(result_array)
+        self.rendered_hash = board.hash
+        return self.rendered
+
+
+class Group:
+    __slots__ = ('group_id', 'color', 'stones', 'liberties', 'hash')
+
+    def __init__(self, group_id, color):
+        self.group_id = group_id
+        self.color = color
+        self.hash = 0
+        self.stones = []
+        self.liberties = set()
+
+    def add_stone(self, stone):
+        self.stones.append(stone)
+
+    def add_liberty(self, liberty):
+        self.liberties.add(liberty)
+
+    def is_dead(self):
+        return len(self.liberties) == 0
+
+
+class TakeOffList:
+    def __init__(self):
+        self.black = []
+        self.white = []
+        self.black_agree = False
+        self.white_agree = False
+        self.black_ready = False
+        self.white_ready = False
+
+    def black_add(self, stone):
+        self.black.append(stone)
+
+    def white_add(self, stone):
+        self.white.append(stone)
+
+    def reset_agreement(self):
+        self.black_agree = False
+        self.white_agree = False
+        self.black_ready = False
+        self.white_ready = False
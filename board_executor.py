@@ -0,0 +1,133 @@
+import asyncio
+import functools
+import logging
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Set
+
+from board import Board
+from games import LiveGame
+from latency import Histogram
+from pools import ProcessPool
+
+INLINE = "inline"
+THREAD = "thread"
+PROCESS = "process"
+
+log = logging.getLogger(__name__)
+
+
+# everything a board method may change but the history and the log, a worker sends back only these
+CHANGED = ('colors', 'group_ids', 'group_dict', 'free_group_ids', 'next_group_id', 'hash', 'current_move',
+           'black_score', 'white_score', 'passes', 'end', 'take_off_list')
+
+
+def _apply(blob, history, log, func, args, changes):
+    # the worker's board takes the shared tables of this process and starts an empty tail of the log
+    board = Board.from_bytes(blob)
+    board.log = log
+    known = set(array('Q', history)) if history is not None else set()
+    board.history = set(known)
+    result = func(board, *args)
+    if not changes:
+        return result, None
+    state = {name: getattr(board, name) for name in CHANGED}
+    return result, (state, board.history - known, board.log)
+
+
+class BoardExecutor:
+    # runs board methods off the event loop, one at a time per game and in parallel across games
+    def __init__(self, kind=THREAD, workers=None):
+        if kind not in (INLINE, THREAD, PROCESS):
+            raise ValueError(f"Unknown board executor {kind}, use {INLINE}, {THREAD} or {PROCESS}")
+        self.kind = kind
+        self.workers = workers
+        self.pool = None
+        # the last queued operation of every game, the next one waits for it
+        self.tails: Dict[str, asyncio.Future] = dict()
+        # games with an operation running, their boards may be half updated
+        self.busy: Set[str] = set()
+        self.waiting: Dict[str, Histogram] = dict()
+        self.running: Dict[str, Histogram] = dict()
+
+    def start(self):
+        if self.kind == THREAD:
+            self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix="board")
+        elif self.kind == PROCESS:
+            self.pool = ProcessPool(self.workers, "board")
+            self.pool.start()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+        for name in sorted(self.running):
+            log.info("%s: waited %s", name, self.waiting[name].summary())
+            log.info("%s: ran %s", name, self.running[name].summary())
+
+    async def run(self, live_game: LiveGame, func, *args):
+        return await self._queue(live_game, func, args, True)
+
+    async def read(self, live_game: LiveGame, func, *args):
+        # for slow methods that leave the board as it was, a process pool doesn't send the board back
+        return await self._queue(live_game, func, args, False)
+
+    async def settled(self, live_game: LiveGame):
+        # waits for the game's queued operations, until its next await the loop reads a board nobody changes.
+        # Quick reads such as display, the turn or the hash are done this way, a worker would rebuild the board first
+        key = live_game.game.name
+        while key in self.tails:
+            await self.tails[key]
+
+    async def _queue(self, live_game: LiveGame, func, args, changes):
+        key = live_game.game.name
+        previous = self.tails.get(key, None)
+        done = asyncio.get_event_loop().create_future()
+        self.tails[key] = done
+        queued = time.perf_counter()
+        try:
+            if previous is not None:
+                await previous
+            started = time.perf_counter()
+            self.busy.add(key)
+            result = await self._call(live_game, func, args, changes)
+        finally:
+            self.busy.discard(key)
+            done.set_result(None)
+            if self.tails.get(key, None) is done:
+                del self.tails[key]
+        finished = time.perf_counter()
+        name = func.__name__
+        if name not in self.running:
+            self.waiting[name] = Histogram()
+            self.running[name] = Histogram()
+        self.waiting[name].observe(started - queued)
+        self.running[name].observe(finished - started)
+        return result
+
+    async def _call(self, live_game: LiveGame, func, args, changes):
+        if self.kind == INLINE:
+            return func(live_game.board, *args)
+        loop = asyncio.get_event_loop()
+        if self.kind == THREAD:
+            return await loop.run_in_executor(self.pool, functools.partial(func, live_game.board, *args))
+        # packed here, the pool would do it later in its own thread while the loop may change the board.
+        # A worker gets the position and the hashes superko needs, not the log, its snapshots or the tables
+        board = live_game.board
+        blob = board.to_bytes(history=False)
+        history = array('Q', board.history).tobytes() if changes else None
+        result, changed = await self.pool.run(_apply, blob, history, board.log.tail(), func, args, changes)
+        if changed is not None:
+            state, added, tail = changed
+            for name, value in state.items():
+                setattr(board, name, value)
+            board.history.update(added)
+            board.log.extend(tail)
+        return result
+
+    def report(self):
+        lines = []
+        for name in sorted(self.running):
+            lines.append(f"{name}\n  waited {self.waiting[name].summary()}\n  ran    {self.running[name].summary()}")
+        return "\n".join(lines) if lines else "No board operations yet"
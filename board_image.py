@@ -0,0 +1,140 @@
+import io
+from collections import OrderedDict
+from functools import lru_cache
+from string import ascii_uppercase
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from board import Board, SIZES
+from instruments import REGISTRY, timed
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+# pixels between lines, boards of every size come out 540 to 570 pixels wide
+CELLS = {9: 52, 13: 38, 19: 27}
+# stones are drawn this many times bigger and scaled down, which smooths their edges
+SUPERSAMPLE = 4
+PALETTE_COLORS = 32
+WOOD = (220, 179, 92)
+LINE = (40, 30, 20)
+IMAGE_CACHE_SIZE = 512
+
+REGISTRY.describe("gobot_board_images_total", "counter", "Board pictures taken from the cache or rendered")
+
+
+def available():
+    return Image is not None
+
+
+def star_points(size):
+    edge = 2 if size < 13 else 3
+    points = (edge, size // 2, size - 1 - edge)
+    return [(row, column) for row in points for column in points]
+
+
+@lru_cache(maxsize=None)
+def sprites(size):
+    # the empty board and both stones for one size, drawn once per process.
+    # All of them share one small palette, palette PNGs encode several times faster than RGB ones
+    cell = CELLS[size]
+    margin = cell * 3 // 2
+    side = 2 * margin + (size - 1) * cell
+    background = Image.new("RGB", (side, side), WOOD)
+    draw = ImageDraw.Draw(background)
+    font = ImageFont.load_default()
+    end = margin + (size - 1) * cell
+    for i in range(size):
+        position = margin + i * cell
+        draw.line([(margin, position), (end, position)], fill=LINE)
+        draw.line([(position, margin), (position, end)], fill=LINE)
+        # columns are numbered and rows lettered, the same as in moves
+        label(draw, font, str(i), position, margin - cell)
+        label(draw, font, ascii_uppercase[i], margin - cell, position)
+    radius = max(2, cell // 10)
+    for row, column in star_points(size):
+        x, y = margin + column * cell, margin + row * cell
+        draw.ellipse([(x - radius, y - radius), (x + radius, y + radius)], fill=LINE)
+    black, black_mask = stone(cell, (20, 20, 20), (0, 0, 0))
+    white, white_mask = stone(cell, (245, 245, 240), (90, 90, 90))
+    sheet = Image.new("RGB", (side + 2 * black.width, side), WOOD)
+    sheet.paste(background, (0, 0))
+    sheet.paste(black, (side, 0))
+    sheet.paste(white, (side + black.width, 0))
+    palette = sheet.quantize(colors=PALETTE_COLORS, dither=Image.NONE)
+    stones = {Board.BLACK: (black.quantize(palette=palette, dither=Image.NONE), black_mask),
+              Board.WHITE: (white.quantize(palette=palette, dither=Image.NONE), white_mask)}
+    return background.quantize(palette=palette, dither=Image.NONE), stones, cell, margin
+
+
+def label(draw, font, text, x, y):
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+    draw.text((x - (left + right) // 2, y - (top + bottom) // 2), text, fill=LINE, font=font)
+
+
+def stone(cell, fill, outline):
+    # a smooth stone already laid on the wood, with the mask of the pixels it covers
+    big = (cell - 1) * SUPERSAMPLE
+    drawn = Image.new("RGBA", (big, big), (0, 0, 0, 0))
+    ImageDraw.Draw(drawn).ellipse([(0, 0), (big - 1, big - 1)], fill=fill, outline=outline, width=SUPERSAMPLE)
+    drawn = drawn.resize((cell - 1, cell - 1), Image.LANCZOS)
+    sprite = Image.new("RGB", drawn.size, WOOD)
+    sprite.paste(drawn, (0, 0), drawn)
+    return sprite, drawn.getchannel("A").point(lambda alpha: 255 if alpha >= 16 else 0).convert("1")
+
+
+@timed("gobot_board_seconds")
+def render_png(board: Board):
+    # runs on the board executor like display, so it may be in another thread or process
+    background, stones, cell, margin = sprites(board.size)
+    image = background.copy()
+    colors = board.board_array
+    offset = margin - (cell - 1) // 2
+    rows, columns = np.nonzero(colors)
+    for row, column in zip(rows.tolist(), columns.tolist()):
+        sprite, mask = stones[int(colors[row, column])]
+        image.paste(sprite, (offset + column * cell, offset + row * cell), mask)
+    output = io.BytesIO()
+    image.save(output, "PNG", compress_level=1)
+    return output.getvalue()
+
+
+class BoardImage:
+    __slots__ = ('png', 'file_id')
+
+    def __init__(self, png):
+        self.png = png
+        # set by the outbox after the first upload, later sends of this position reuse it
+        self.file_id = None
+
+
+class ImageCache:
+    # pictures by board size and position hash, the least recently sent ones go first
+    def __init__(self, capacity=IMAGE_CACHE_SIZE):
+        self.capacity = capacity
+        self.images: Dict[Tuple[int, int], BoardImage] = OrderedDict()
+
+    def __len__(self):
+        return len(self.images)
+
+    def get(self, key) -> Optional[BoardImage]:
+        image = self.images.get(key, None)
+        if image is not None:
+            self.images.move_to_end(key)
+            REGISTRY.inc("gobot_board_images_total", result="hit")
+        return image
+
+    def put(self, key, png):
+        REGISTRY.inc("gobot_board_images_total", result="rendered")
+        image = self.images[key] = BoardImage(png)
+        if len(self.images) > self.capacity:
+            self.images.popitem(last=False)
+        return image
+
+
+if available():
+    for _size in SIZES:
+        sprites(_size)
@@ -0,0 +1,192 @@
+import math
+import random
+import time
+
+import numpy as np
+
+import analysis
+import scoring
+from board import Board
+from pools import ProcessPool
+
+PASS = 0
+EXPLORATION = 1.0
+# points played per playout step in one batch, bigger boards expand fewer children at a time
+BATCH_POINTS = 4096
+
+
+class Node:
+    __slots__ = ('board', 'array', 'move', 'color', 'parent', 'children', 'untried', 'visits', 'wins')
+
+    def __init__(self, board, array, move, color, parent=None):
+        # the Board is only built when the node is expanded, the array is enough for playouts
+        self.board = board
+        self.array = array
+        self.move = move
+        # the colour that played the move leading here, wins are counted for it
+        self.color = color
+        self.parent = parent
+        self.children = []
+        self.untried = None
+        self.visits = 0
+        self.wins = 0.0
+
+    def passes(self):
+        if self.move == PASS:
+            return self.parent.passes() + 1
+        return 0 if self.parent is not None else self.board.passes
+
+    def position(self):
+        if self.board is None:
+            board = copy_board(self.parent.position())
+            if self.move == PASS:
+                board.passes += 1
+            else:
+                board.place(self.move, self.color)
+                board.history.add(board.hash)
+                board.passes = 0
+            board.current_move = opponent(self.color)
+            self.board = board
+        return self.board
+
+    def is_expanded(self):
+        return self.untried == []
+
+    def expand(self, width, rng):
+        # creates up to width children, their positions are made in one batch
+        board = self.position()
+        color = board.current_move
+        if self.untried is None:
+            self.untried = candidate_moves(board, rng)
+        moves = []
+        while self.untried and len(moves) < width:
+            move = self.untried.pop()
+            if move == PASS or board.check_move(move, color) == Board.FINE:
+                moves.append(move)
+        if not moves:
+            return []
+        stones = [board.stone(move) for move in moves if move != PASS]
+        arrays = np.repeat(board.board_array[np.newaxis], len(moves), axis=0)
+        if stones:
+            rows, columns = zip(*stones)
+            placed = [i for i, move in enumerate(moves) if move != PASS]
+            arrays[placed] = analysis.play(arrays[placed], rows, columns, color)[0]
+        children = [Node(None, array, move, color, self) for move, array in zip(moves, arrays)]
+        self.children.extend(children)
+        return children
+
+    def select(self):
+        log_visits = math.log(self.visits)
+        return max(self.children, key=lambda child: child.wins / child.visits +
+                   EXPLORATION * math.sqrt(log_visits / child.visits))
+
+
+def candidate_moves(board: Board, rng):
+    color = board.current_move
+    padded = np.frombuffer(board.colors, dtype=np.int8).reshape(board.width, board.width)
+    own_eye = np.logical_and.reduce([(side == color) | (side == board.BORDER) for side in scoring.neighbours(padded)])
+    rows, columns = np.nonzero((board.board_array == 0) & ~own_eye)
+    moves = [board.point((int(row), int(column))) for row, column in zip(rows, columns)]
+    rng.shuffle(moves)
+    # popped last, so passing is only considered next to every other move
+    return [PASS] + moves
+
+
+def opponent(color):
+    return Board.WHITE if color == Board.BLACK else Board.BLACK
+
+
+def copy_board(board: Board):
+    # a search board only needs stones, groups, the side to move and the position history
+    copy = Board(board.size)
+    copy.colors[:] = board.colors
+    copy.update_groups()
+    copy.history = set(board.history)
+    copy.current_move = board.current_move
+    copy.passes = board.passes
+    return copy
+
+
+def playouts(boards, colors, passes, komi, rng: np.random.Generator):
+    # plays random games on a stack of positions at once, returns which of them black won
+    count, size = boards.shape[:2]
+    index = np.arange(count)
+    for _ in range(2 * size * size):
+        if (passes >= 2).all():
+            break
+        padded = analysis.pad(boards)
+        own = colors[:, np.newaxis, np.newaxis]
+        own_eye = np.logical_and.reduce([(side == own) | (side == Board.BORDER) for side in scoring.neighbours(padded)])
+        keys = rng.random(boards.shape)
+        keys[(boards != 0) | own_eye | (passes >= 2)[:, np.newaxis, np.newaxis]] = -1
+        keys = keys.reshape(count, -1)
+        choice = keys.argmax(axis=1)
+        has_move = keys[index, choice] >= 0
+        played, _, legal = analysis.play(boards, choice // size, choice % size, colors)
+        legal &= has_move
+        boards = np.where(legal[:, np.newaxis, np.newaxis], played, boards)
+        passes = np.where(legal, 0, passes + 1)
+        colors = np.where(colors == Board.BLACK, Board.WHITE, Board.BLACK).astype(np.int8)
+    black, white = analysis.score(boards, rules=scoring.AREA, komi=komi)
+    return black > white
+
+
+def evaluate(children, repeats, komi, rng):
+    boards = np.repeat(np.stack([child.array for child in children]), repeats, axis=0)
+    colors = np.repeat([opponent(child.color) for child in children], repeats).astype(np.int8)
+    passes = np.repeat([child.passes() for child in children], repeats)
+    black_won = playouts(boards, colors, passes, komi, rng).reshape(len(children), repeats)
+    return black_won.sum(axis=1)
+
+
+def search(blob, think_time, komi=0, width=None, repeats=2, seed=None):
+    # returns the point to play on the padded board of the position, PASS to pass
+    rng = random.Random(seed)
+    playout_rng = np.random.default_rng(seed)
+    board = Board.from_bytes(blob)
+    if width is None:
+        width = max(4, BATCH_POINTS // (repeats * board.size * board.size))
+    root = Node(copy_board(board), board.board_array.copy(), None, opponent(board.current_move))
+    deadline = time.monotonic() + think_time
+    while time.monotonic() < deadline:
+        node = root
+        while node.is_expanded() and node.children:
+            node = node.select()
+        children = [] if node.passes() >= 2 else node.expand(width, rng)
+        if not children:
+            children = [node]
+            node = node.parent
+        black_wins = evaluate(children, repeats, komi, playout_rng)
+        for child, wins in zip(children, black_wins):
+            child.visits += repeats
+            child.wins += wins if child.color == Board.BLACK else repeats - wins
+        total = int(black_wins.sum())
+        visits = repeats * len(children)
+        while node is not None:
+            node.visits += visits
+            node.wins += total if node.color == Board.BLACK else visits - total
+            node = node.parent
+    if not root.children:
+        return PASS
+    # visits grow a whole batch at a time, so the most visited child is not always the best one
+    return max(root.children, key=lambda child: child.wins / child.visits - 2 / math.sqrt(child.visits)).move
+
+
+class BotPlayer:
+    def __init__(self, think_time=2.0, processes=None, komi=0):
+        self.think_time = think_time
+        self.processes = processes
+        self.komi = komi
+        self.pool = None
+
+    def start(self):
+        self.pool = ProcessPool(self.processes, "search")
+        self.pool.start()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+    async def choose_move(self, board: Board):
+        return await self.pool.run(search, board.to_bytes(), self.think_time, self.komi)
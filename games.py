@@ -0,0 +1,393 @@
+import asyncio
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Set, Tuple
+
+from board import Board
+
+import time
+
+# the computer opponent plays white under this id, no Telegram chat has it
+BOT_ID = 0
+BOT_NAME = "GoBot"
+
+
+def turn(board: Board):
+    # the colour to move, 0 once the game has ended
+    return 0 if board.end else board.current_move
+
+
+class Game:
+    def __init__(self, creator, creator_id, name, size):
+        self.creator = creator
+        self.creator_id = creator_id
+        self.name = name
+        self.size = size
+
+    def __str__(self):
+        return f"{self.creator}: {self.name}\n    size: {self.size}x{self.size}"
+
+
+# messages a chat keeps in memory, older ones are read back from the store a page at a time
+CHAT_CAPACITY = 60
+CHAT_PAGE_SIZE = 20
+# longer messages are cut on history pages, so a whole page fits in one Telegram message
+CHAT_LINE_LIMIT = 190
+# rendered pages kept per chat, only full ones since those never change
+CHAT_CACHED_PAGES = 4
+
+
+class Chat:
+    def __init__(self, recent=(), total=0, capacity=CHAT_CAPACITY):
+        self.recent: Deque[str] = deque(recent, maxlen=capacity)
+        # messages ever sent, the sequence number of the next one
+        self.total = total
+        # messages the store hasn't written yet, with their sequence numbers
+        self.unsaved: List[Tuple[int, str]] = []
+        self.pages: Dict[int, str] = OrderedDict()
+
+    def add(self, message: str, sender: str):
+        line = f"{sender}: {message}"
+        self.recent.append(line)
+        self.unsaved.append((self.total, line))
+        self.total += 1
+
+    def take_unsaved(self):
+        unsaved = self.unsaved
+        self.unsaved = []
+        return unsaved
+
+    def page_count(self):
+        return max(1, -(-self.total // CHAT_PAGE_SIZE))
+
+    async def page(self, page, load: Callable[[int, int], Awaitable[List[Tuple[int, str]]]]):
+        # load(first, last) gives the stored messages with sequence numbers in [first, last)
+        text = self.pages.get(page, None)
+        if text is not None:
+            self.pages.move_to_end(page)
+            return text
+        first = page * CHAT_PAGE_SIZE
+        last = min(self.total, first + CHAT_PAGE_SIZE)
+        in_memory = self.total - len(self.recent)
+        lines = dict(await load(first, min(last, in_memory))) if first < in_memory else dict()
+        lines.update((seq, line) for seq, line in self.unsaved if first <= seq < last)
+        for seq in range(max(first, in_memory), last):
+            lines[seq] = self.recent[seq - in_memory]
+        text = "\n".join(clip(lines[seq]) for seq in sorted(lines))
+        if text == "":
+            return "Chat history is empty"
+        # a page missing messages that are being written right now is not kept
+        if len(lines) == CHAT_PAGE_SIZE:
+            self.pages[page] = text
+            if len(self.pages) > CHAT_CACHED_PAGES:
+                self.pages.popitem(last=False)
+        return text
+
+
+def clip(line):
+    return line if len(line) <= CHAT_LINE_LIMIT else line[:CHAT_LINE_LIMIT - 1] + "…"
+
+
+class BoardView:
+    # a board message with buttons in a player's chat, on big boards the buttons cover a window of it
+    __slots__ = ('message_id', 'top', 'left')
+
+    def __init__(self, message_id, top=0, left=0):
+        self.message_id = message_id
+        self.top = top
+        self.left = left
+
+
+class LiveGame:
+    def __init__(self, game, opponent, opponent_id):
+        self.game = game
+        self.opponent = opponent
+        self.opponent_id = opponent_id
+        self.board = Board(self.game.size)
+        self.chat = Chat()
+        # the board messages edited after every move, by player id
+        self.views: Dict[int, BoardView] = dict()
+        # players who get the board as a picture instead of text
+        self.picture_players: Set[int] = set()
+        self.last_used = time.monotonic()
+        # whose move it is while the board is not in memory
+        self.turn = Board.BLACK
+
+    def is_hydrated(self):
+        return self.board is not None
+
+    def dehydrate(self):
+        if self.board is not None:
+            self.turn = turn(self.board)
+        self.board = None
+        self.chat = None
+
+    def __str__(self):
+        return f"{self.game.name}: {self.game.creator} vs {self.opponent} \n" \
+               f"    {self.game.size}x{self.game.size}. {self.current_player()}'s move"
+
+    def other_player(self, player_id):
+        if player_id == self.opponent_id:
+            return self.game.creator_id
+        else:
+            return self.opponent_id
+
+    def is_creator(self, uid):
+        return uid == self.game.creator_id
+
+    def is_bot_game(self):
+        return self.opponent_id == BOT_ID
+
+    def current_player(self):
+        if (self.turn if self.board is None else self.board.current_move) == Board.BLACK:
+            return self.game.creator
+        else:
+            return self.opponent
+
+    def result(self):
+        return f"The game {self.game.name} has ended. \n" \
+               f"{self.game.creator}: {self.board.black_score} vs {self.opponent}: {self.board.white_score} \n" \
+               f"{'White' if self.board.white_score >= self.board.black_score else 'Black'} won"
+
+
+class GameBuilder:
+    def __init__(self):
+        self._creator = ''
+        self._creator_id = -1
+        self._name = 'Friendly game'
+        self._size = 19
+        self._bot = False
+
+    def build(self):
+        return Game(self._creator, self._creator_id, self._name, self._size)
+
+    def creator(self, creator):
+        self._creator = creator
+        return self
+
+    def creator_id(self, creator_id):
+        self._creator_id = creator_id
+        return self
+
+    def name(self, name):
+        self._name = name
+        return self
+
+    def size(self, size):
+        self._size = size
+        return self
+
+    def bot(self, bot=True):
+        self._bot = bot
+        return self
+
+    def is_bot(self):
+        return self._bot
+
+
+class GameRegistry:
+    def __init__(self, store=None):
+        self.store = store
+        self.new_games: Dict[str, Game] = dict()
+        self.live_games: Dict[str, LiveGame] = dict()
+        self.new_by_creator_id: Dict[int, Dict[str, Game]] = dict()
+        self.live_by_player_id: Dict[int, Dict[str, LiveGame]] = dict()
+        self.live_by_player_name: Dict[str, Dict[str, LiveGame]] = dict()
+        # boards being read from the store, everybody opening the game meanwhile waits for the same read
+        self.hydrating: Dict[str, asyncio.Future] = dict()
+
+    def name_taken(self, game_name):
+        return game_name in self.new_games or game_name in self.live_games
+
+    def open_games(self):
+        return self.new_games.values()
+
+    def open_game(self, game_name):
+        return self.new_games.get(game_name, None)
+
+    def open_games_by_creator(self, creator_id):
+        return self.new_by_creator_id.get(creator_id, {}).values()
+
+    def live_games_by_name(self, name):
+        # only what the lists show, the boards stay where they are
+        return list(self.live_by_player_name.get(name, {}).values())
+
+    async def live_games_by_id(self, player_id):
+        games = list(self.live_by_player_id.get(player_id, {}).values())
+        for live_game in games:
+            await self.hydrate(live_game)
+        return games
+
+    def find_live_game(self, game_name, name):
+        the_game = self.live_games.get(game_name, None)
+        if the_game is None:
+            return None
+        if name != the_game.game.creator and name != the_game.opponent:
+            return None
+        return the_game
+
+    async def live_game(self, game_name, name):
+        the_game = self.find_live_game(game_name, name)
+        return None if the_game is None else await self.hydrate(the_game)
+
+    async def refresh_turns(self, games):
+        # a lobby doesn't own the boards, it shows the turns the game workers saved last
+        games = [live_game for live_game in games if not live_game.is_hydrated()]
+        if self.store is None or not games:
+            return
+        turns = await self._read(self.store.load_turns, [live_game.game.name for live_game in games])
+        for live_game in games:
+            live_game.turn = turns.get(live_game.game.name, live_game.turn)
+
+    async def opponent_turns(self, opponent_id):
+        # the games waiting for this opponent's move, the boards of the others stay on disk
+        names = await self._read(self.store.opponent_turns, opponent_id)
+        games = [self.live_games[name] for name in names if name in self.live_games]
+        for live_game in games:
+            await self.hydrate(live_game)
+        return games
+
+    @staticmethod
+    async def _read(func, *args):
+        # a flush holds the store's lock for a whole transaction, reads wait for it off the event loop
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def hydrate(self, live_game: LiveGame):
+        live_game.last_used = time.monotonic()
+        if live_game.is_hydrated():
+            return live_game
+        name = live_game.game.name
+        loading = self.hydrating.get(name, None)
+        if loading is None:
+            loading = self.hydrating[name] = asyncio.ensure_future(self._read(self.store.load_board, live_game))
+            loading.add_done_callback(lambda _: self.hydrating.pop(name, None))
+        board, chat = await asyncio.shield(loading)
+        # the first one back sets them, a move may already have been made on the board when the others get here
+        if not live_game.is_hydrated():
+            live_game.board = board
+            live_game.chat = chat
+        return live_game
+
+    async def chat_page(self, live_game: LiveGame, page):
+        async def load(first, last):
+            if self.store is None:
+                return []
+            return await self._read(self.store.load_chat, live_game.game.name, first, last)
+
+        return await live_game.chat.page(page, load)
+
+    def save(self, live_game: LiveGame):
+        if self.store is not None:
+            self.store.save_live_game(live_game)
+
+    async def load(self, open_games=True, owns=None):
+        # a sharded worker only keeps the live games it owns and leaves the open ones to the lobby
+        if open_games:
+            for game in await self._read(self.store.load_open_games):
+                self._index_open(game)
+        for live_game in await self._read(self.store.load_live_games):
+            if owns is None or owns(live_game.game.name):
+                self._index_live(live_game)
+
+    async def adopt(self, game_name):
+        # a game another process started, read from the store
+        live_game = self.live_games.get(game_name, None)
+        if live_game is None:
+            live_game = await self._read(self.store.load_live_game, game_name)
+            # another update may have adopted it meanwhile
+            if live_game is not None and game_name not in self.live_games:
+                self._index_live(live_game)
+            live_game = self.live_games.get(game_name, None)
+        return live_game
+
+    async def refresh_player(self, player_id):
+        # forgets the player's games that another process has finished
+        for game_name in list(self.live_by_player_id.get(player_id, {})):
+            if not await self._read(self.store.has_live_game, game_name):
+                self._unindex_live(game_name)
+
+    def evict_idle(self, max_idle):
+        now = time.monotonic()
+        evicted = 0
+        for name, live_game in self.live_games.items():
+            if not live_game.is_hydrated() or now - live_game.last_used < max_idle:
+                continue
+            if self.store.is_pending(name):
+                continue
+            live_game.dehydrate()
+            evicted += 1
+        return evicted
+
+    def add(self, game: Game):
+        self._index_open(game)
+        if self.store is not None:
+            self.store.save_open_game(game)
+
+    def delete(self, game_name):
+        game = self.new_games.pop(game_name)
+        self._unindex(self.new_by_creator_id, game.creator_id, game_name)
+        if self.store is not None:
+            self.store.delete_open_game(game_name)
+        return game
+
+    def join(self, game_name, opponent, opponent_id):
+        if game_name not in self.new_games:
+            return None
+        game = self.delete(game_name)
+        return self._start(LiveGame(game, opponent, opponent_id))
+
+    def start_bot_game(self, game: Game):
+        return self._start(LiveGame(game, BOT_NAME, BOT_ID))
+
+    def _start(self, live_game: LiveGame):
+        self._index_live(live_game)
+        if self.store is not None:
+            self.store.save_live_game(live_game, started=True)
+        return live_game
+
+    def _index_open(self, game: Game):
+        self.new_games[game.name] = game
+        self.new_by_creator_id.setdefault(game.creator_id, dict())[game.name] = game
+
+    def _index_live(self, live_game: LiveGame):
+        game = live_game.game
+        game_name = game.name
+        opponent = live_game.opponent
+        opponent_id = live_game.opponent_id
+        self.live_games[game_name] = live_game
+        for player_id in (game.creator_id, opponent_id):
+            self.live_by_player_id.setdefault(player_id, dict())[game_name] = live_game
+        for player in (game.creator, opponent):
+            self.live_by_player_name.setdefault(player, dict())[game_name] = live_game
+
+    def _unindex_live(self, game_name):
+        live_game = self.live_games.pop(game_name, None)
+        if live_game is None:
+            return None
+        for player_id in (live_game.game.creator_id, live_game.opponent_id):
+            self._unindex(self.live_by_player_id, player_id, game_name)
+        for player in (live_game.game.creator, live_game.opponent):
+            self._unindex(self.live_by_player_name, player, game_name)
+        return live_game
+
+    def finish(self, game_name):
+        live_game = self._unindex_live(game_name)
+        if live_game is None:
+            return None
+        if self.store is not None:
+            self.store.delete_live_game(game_name)
+        return live_game
+
+    def resign(self, game_name, player_id):
+        live_game = self.live_games.get(game_name, None)
+        if live_game is None or player_id not in (live_game.game.creator_id, live_game.opponent_id):
+            return None
+        return self.finish(game_name)
+
+    @staticmethod
+    def _unindex(index, key, game_name):
+        games = index.get(key, None)
+        if games is None:
+            return
+        games.pop(game_name, None)
+        if not games:
+            del index[key]
@@ -0,0 +1,137 @@
+import functools
+import logging
+import os
+import resource
+import time
+from typing import Callable, Dict, Tuple
+
+from latency import Histogram
+
+log = logging.getLogger(__name__)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format(name, labels, value):
+    if labels:
+        name += "{" + ",".join(f'{key}="{_escape(label)}"' for key, label in labels) + "}"
+    return f"{name} {value!r}" if isinstance(value, float) else f"{name} {value}"
+
+
+class Metrics:
+    # counters, gauges and latency histograms in the Prometheus text format.
+    # Recording is a dict lookup and a few additions, the text is only built when somebody scrapes it
+    def __init__(self):
+        self.descriptions: Dict[str, Tuple[str, str]] = dict()
+        self.counters: Dict[str, Dict[tuple, float]] = dict()
+        self.histograms: Dict[str, Dict[tuple, Histogram]] = dict()
+        self.gauges: Dict[str, Callable[[], float]] = dict()
+        # histograms kept by somebody else, one label value per dict key
+        self.families: Dict[str, Tuple[str, Dict[str, Histogram]]] = dict()
+
+    def describe(self, name, kind, text):
+        self.descriptions[name] = (kind, text)
+
+    def inc(self, name, amount=1, **labels):
+        samples = self.counters.setdefault(name, dict())
+        key = _labels(labels)
+        samples[key] = samples.get(key, 0) + amount
+
+    def histogram(self, name, **labels) -> Histogram:
+        samples = self.histograms.setdefault(name, dict())
+        key = _labels(labels)
+        histogram = samples.get(key, None)
+        if histogram is None:
+            histogram = samples[key] = Histogram()
+        return histogram
+
+    def observe(self, name, seconds, **labels):
+        self.histogram(name, **labels).observe(seconds)
+
+    def gauge(self, name, text, func):
+        self.describe(name, "gauge", text)
+        self.gauges[name] = func
+
+    def histogram_family(self, name, text, label, histograms: Dict[str, Histogram]):
+        self.describe(name, "histogram", text)
+        self.families[name] = (label, histograms)
+
+    def _header(self, lines, name, kind):
+        text = self.descriptions.get(name, (kind, ""))[1]
+        if text:
+            lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    @staticmethod
+    def _histogram_lines(lines, name, labels, histogram: Histogram):
+        # Prometheus buckets are cumulative, ours count each bucket on its own
+        seen = 0
+        for bound, count in zip(histogram.bounds, histogram.counts):
+            seen += count
+            lines.append(_format(name + "_bucket", labels + (("le", f"{bound:g}"),), seen))
+        lines.append(_format(name + "_bucket", labels + (("le", "+Inf"),), histogram.count))
+        lines.append(_format(name + "_sum", labels, float(histogram.sum)))
+        lines.append(_format(name + "_count", labels, histogram.count))
+
+    def render(self):
+        lines = []
+        for name in sorted(self.counters):
+            self._header(lines, name, "counter")
+            for labels, value in sorted(self.counters[name].items()):
+                lines.append(_format(name, labels, value))
+        for name in sorted(self.gauges):
+            self._header(lines, name, "gauge")
+            try:
+                lines.append(_format(name, (), self.gauges[name]()))
+            except Exception:
+                log.exception("Gauge %s failed", name)
+        for name in sorted(self.histograms):
+            self._header(lines, name, "histogram")
+            # copied first, board threads may add a label while we are writing
+            for labels, histogram in sorted(list(self.histograms[name].items())):
+                self._histogram_lines(lines, name, labels, histogram)
+        for name in sorted(self.families):
+            self._header(lines, name, "histogram")
+            label, histograms = self.families[name]
+            for value, histogram in sorted(list(histograms.items())):
+                self._histogram_lines(lines, name, ((label, value),), histogram)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Metrics()
+REGISTRY.describe("gobot_board_seconds", "histogram", "Board method durations")
+
+
+def timed(name, **labels):
+    # the histogram is looked up once, a call costs two clock reads and an observe.
+    # Called from board threads without a lock, a rare lost increment is fine for metrics
+    def decorator(func):
+        histogram = REGISTRY.histogram(name, op=func.__name__, **labels)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def resident_memory():
+    # current RSS on Linux, elsewhere the peak is the best there is
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+REGISTRY.gauge("gobot_resident_memory_bytes", "Resident memory of the process", resident_memory)
@@ -1,6 +1,11 @@
+from functools import lru_cache
+from string import ascii_lowercase
+
 from aiogram.types import KeyboardButton, ReplyKeyboardMarkup,\
     ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 
+from board import Board
+
 logged_keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
 new_game_button = KeyboardButton("/new_game")
 delete_game_button = KeyboardButton("/delete_game")
@@ -24,6 +29,11 @@ medium_button = KeyboardButton("13")
 big_button = KeyboardButton("19")
 game_size_keyboard = game_size_keyboard.insert(small_button).insert(medium_button).insert(big_button)
 
+opponent_keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
+human_button = KeyboardButton("Human")
+computer_button = KeyboardButton("Computer")
+opponent_keyboard = opponent_keyboard.insert(human_button).insert(computer_button)
+
 game_keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
 make_move_button = KeyboardButton("/make_move")
 board_button = KeyboardButton("/board")
@@ -31,9 +41,11 @@ chat_button = KeyboardButton("/chat")
 pass_button = KeyboardButton("/pass")
 resign_button = KeyboardButton("/resign")
 close_game_button = KeyboardButton("/close_game")
-game_keyboard = game_keyboard.add(make_move_button).insert(board_button)\
+buttons_button = KeyboardButton("/buttons")
+pictures_button = KeyboardButton("/pictures")
+game_keyboard = game_keyboard.add(make_move_button).insert(board_button).insert(buttons_button)\
     .add(chat_button).insert(pass_button).insert(resign_button)\
-    .add(close_game_button)
+    .add(close_game_button).insert(pictures_button)
 
 chat_keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
 close_chat_button = KeyboardButton("/close_chat")
@@ -49,3 +61,49 @@ make_move_keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
 cancel_move_button = KeyboardButton("/cancel_move")
 make_move_keyboard = make_move_keyboard.add(board_button)\
     .add(cancel_move_button)
+
+HISTORY_PREFIX = "history:"
+
+
+def history_keyboard(page, pages):
+    # pages go from the oldest, the middle button shows the page again with messages sent since
+    if pages <= 1:
+        return None
+    keyboard = InlineKeyboardMarkup(row_width=3)
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("‹ Older", callback_data=f"{HISTORY_PREFIX}{page - 1}"))
+    buttons.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"{HISTORY_PREFIX}{page}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("Newer ›", callback_data=f"{HISTORY_PREFIX}{page + 1}"))
+    return keyboard.row(*buttons)
+
+MOVE_PREFIX = "move:"
+VIEW_PREFIX = "view:"
+# Telegram takes at most 100 buttons, bigger boards show a window of this size that can be moved around
+VIEW_SIZE = 9
+VIEW_STEP = 4
+EMPTY_POINT = "·"
+
+
+@lru_cache(maxsize=4096)
+def board_row(cells: bytes, row, left):
+    # buttons of one row of the window, rebuilt only when a stone in it changes
+    cell_text = (EMPTY_POINT, Board.BLACK_CIRCLE, Board.WHITE_CIRCLE)
+    return tuple(InlineKeyboardButton(cell_text[cell], callback_data=f"{MOVE_PREFIX}{ascii_lowercase[row]}{left + i}")
+                 for i, cell in enumerate(cells))
+
+
+def board_keyboard(board, top, left):
+    size = min(board.size, VIEW_SIZE)
+    keyboard = InlineKeyboardMarkup(row_width=size)
+    for row in range(top, top + size):
+        start = board.point((row, left))
+        keyboard.row(*board_row(bytes(board.colors[start:start + size]), row, left))
+    if board.size > VIEW_SIZE:
+        last = board.size - VIEW_SIZE
+        arrows = (("◀", top, max(0, left - VIEW_STEP)), ("▲", max(0, top - VIEW_STEP), left),
+                  ("▼", min(last, top + VIEW_STEP), left), ("▶", top, min(last, left + VIEW_STEP)))
+        keyboard.row(*(InlineKeyboardButton(arrow, callback_data=f"{VIEW_PREFIX}{row}:{column}")
+                       for arrow, row, column in arrows))
+    return keyboard
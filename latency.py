@@ -0,0 +1,43 @@
+from bisect import bisect_left
+
+# upper bounds in seconds, doubling from 0.1 ms to about 13 s, the last bucket takes everything above
+BOUNDS = tuple(0.0001 * 2 ** i for i in range(18))
+
+
+class Histogram:
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def summary(self):
+        if not self.count:
+            return "no samples"
+        return f"n={self.count} mean={self.sum / self.count * 1000:.2f} ms " \
+               f"p50<={self.quantile(0.5) * 1000:.1f} ms p90<={self.quantile(0.9) * 1000:.1f} ms " \
+               f"p99<={self.quantile(0.99) * 1000:.1f} ms"
+
+    def display(self):
+        lines = []
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            if count:
+                lines.append(f"<= {bound * 1000:9.1f} ms {count:7} {'#' * max(1, 40 * count // self.count)}")
+        return "\n".join(lines)
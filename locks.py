@@ -0,0 +1,32 @@
+import asyncio
+import contextlib
+from typing import Dict
+
+
+class GameLocks:
+    # one asyncio lock per game, dropped as soon as nobody holds or waits for it so ended games leave nothing behind
+    def __init__(self):
+        self.locks: Dict[str, asyncio.Lock] = dict()
+        self.users: Dict[str, int] = dict()
+
+    def __len__(self):
+        return len(self.locks)
+
+    def locked(self, key):
+        lock = self.locks.get(key, None)
+        return lock is not None and lock.locked()
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        lock = self.locks.get(key, None)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        self.users[key] = self.users.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.users[key] -= 1
+            if not self.users[key]:
+                del self.users[key]
+                del self.locks[key]
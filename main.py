@@ -1,13 +1,67 @@
+import config
 from config import BOT_TOKEN
 from typing import Dict, List
 
+import argparse
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+from string import ascii_uppercase
+
 from aiogram import Bot, Dispatcher, types, executor
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.bot.api import TelegramAPIServer
 from aiogram.dispatcher import FSMContext
+from aiogram.utils.exceptions import MessageNotModified
 from keyboards import *
-
-import numpy as np
-import string
+from board import Board
+from board_executor import BoardExecutor
+from board_image import IMAGE_CACHE_SIZE, ImageCache, available as pictures_available, render_png
+from engine import PASS, BotPlayer
+from games import BOT_ID, BOT_NAME, BoardView, GameBuilder, GameRegistry
+from locks import GameLocks
+from metrics import REGISTRY, MetricsMiddleware, serve as serve_metrics
+from outbox import GLOBAL_RATE, Outbox
+from profiler import MAX_SECONDS, Profiling
+from shard import LOBBY, Router, Shard, run_router, run_worker, socket_path
+from storage import GameStore, SQLiteStorage
+from webhook import run_webhook
+
+DATABASE_PATH = getattr(config, "DATABASE_PATH", "gobot.db")
+# seconds without a message before a game's board and chat are dropped from memory
+COLD_GAME_SECONDS = getattr(config, "COLD_GAME_SECONDS", 600)
+# "territory" or "area" scoring, komi is added to white's score
+SCORING_RULES = getattr(config, "SCORING_RULES", "territory")
+KOMI = getattr(config, "KOMI", 0)
+# seconds the computer opponent thinks per move and its worker processes, None is one per CPU
+BOT_THINK_TIME = getattr(config, "BOT_THINK_TIME", 2.0)
+BOT_PROCESSES = getattr(config, "BOT_PROCESSES", None)
+# where moves, scoring and rendering run: "thread" or "process" pool, or "inline" on the event loop
+BOARD_EXECUTOR = getattr(config, "BOARD_EXECUTOR", "thread")
+BOARD_WORKERS = getattr(config, "BOARD_WORKERS", None)
+# webhook mode, the path is derived from the token unless set so it stays hard to guess
+WEBHOOK_HOST = getattr(config, "WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = getattr(config, "WEBHOOK_PORT", 8080)
+WEBHOOK_PATH = getattr(config, "WEBHOOK_PATH", "/webhook/" + hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32])
+WEBHOOK_URL = getattr(config, "WEBHOOK_URL", None)
+WEBHOOK_SECRET = getattr(config, "WEBHOOK_SECRET", None)
+TELEGRAM_API_SERVER = getattr(config, "TELEGRAM_API_SERVER", None)
+# sharded mode, the router talks to its workers over unix sockets in this directory
+SOCKET_DIR = getattr(config, "SOCKET_DIR", tempfile.gettempdir())
+# Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics, off when None.
+# Sharded workers listen on METRICS_PORT + their index, the lobby being 0
+METRICS_HOST = getattr(config, "METRICS_HOST", "127.0.0.1")
+METRICS_PORT = getattr(config, "METRICS_PORT", None)
+# board pictures kept with their Telegram file ids, needs Pillow
+IMAGE_CACHE_SIZE = getattr(config, "IMAGE_CACHE_SIZE", IMAGE_CACHE_SIZE)
+# chat ids allowed to run /profile, and where it leaves its stacks files
+ADMIN_IDS = getattr(config, "ADMIN_IDS", ())
+PROFILE_DIR = getattr(config, "PROFILE_DIR", tempfile.gettempdir())
 
 NAME_STATE = "name"
 LOGGED_STATE = "logged"
@@ -16,6 +70,7 @@ NEW_GAME_NAME_CANCELLATION_STATE = "new_game_name_cancellation"
 NEW_GAME_NAME_CONFIRMATION_STATE = "new_game_name_confirmation"
 NEW_GAME_SIZE_STATE = "new_game_size_state"
 NEW_GAME_SIZE_CANCELLATION_STATE = "new_game_size_cancellation"
+NEW_GAME_OPPONENT_STATE = "new_game_opponent"
 GAME_DELETION_STATE = "game_deletion"
 GAME_DELETION_CONFIRMATION_STATE = "game_deletion_confirmation"
 JOIN_STATE = "join"
@@ -28,351 +83,288 @@ GAME_RESIGN_STATE = "game_resign"
 # new states
 TAKE_OFF_STATE = "take_off"
 TAKE_OFF_CONFIRM_STATE = "take_off_confirm"
+# updates in these states go to the worker owning the current game when sharded
+GAME_STATES = (GAME_STATE, GAME_MOVE_STATE, GAME_CHAT_STATE, GAME_RESIGN_STATE, TAKE_OFF_STATE, TAKE_OFF_CONFIRM_STATE)
+# states in which the buttons of a board message make moves
+BOARD_VIEW_STATES = (GAME_STATE, GAME_MOVE_STATE, GAME_CHAT_STATE)
+
+log = logging.getLogger(__name__)
+
+MOVE_ERRORS = {
+    Board.NOT_YOUR_TURN: "It's not your turn",
+    Board.INVALID_NOTATION: "Move should be letter and a number without a space i.e a0, f10 or e3",
+    Board.INVALID_POSITION: "You are trying to place a stone outside of the board",
+    Board.PLACE_TAKEN: "There is already a stone there",
+    Board.ILLEGAL_SUICIDE: "This move kills your stones, it's illegal",
+    Board.ILLEGAL_KO: "This move repeats positions, first make a move somewhere else",
+}
+
+
+def stones_text(board, stones):
+    if not stones:
+        return "none"
+    return ", ".join(board.notation(stone) for stone in stones)
+
+
+def take_off_proposal(board, picture):
+    return f"These stones look dead: {stones_text(board, board.take_off_list.black)}\n" \
+           f"Enter /take_off_confirm to agree or /take_off to change them\n{picture}"
+
+
+def board_view_text(the_game, view, picture=None):
+    board = the_game.board
+    lines = [f"{the_game.game.name}: {the_game.game.creator} {Board.BLACK_CIRCLE} vs "
+             f"{the_game.opponent} {Board.WHITE_CIRCLE}"]
+    if board.end:
+        lines.append("Both players passed, enter /take_off to remove dead stones")
+    else:
+        lines.append(f"{the_game.current_player()}'s move, tap a point to play")
+    if picture is not None:
+        # the buttons show part of a big board, the whole of it is drawn above them
+        lines.append(picture)
+        lines.append(f"Buttons: rows {ascii_uppercase[view.top]}-{ascii_uppercase[view.top + VIEW_SIZE - 1]}, "
+                     f"columns {view.left}-{view.left + VIEW_SIZE - 1}")
+    return "\n".join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Go bot for Telegram")
+    parser.add_argument("--webhook", action="store_true", help="receive updates through a webhook instead of polling")
+    parser.add_argument("--host", default=WEBHOOK_HOST)
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT)
+    parser.add_argument("--path", default=WEBHOOK_PATH)
+    parser.add_argument("--url", default=WEBHOOK_URL, help="public base url to register the webhook with Telegram")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="run a webhook router, a lobby and this many game worker processes")
+    parser.add_argument("--shard", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--socket-dir", default=SOCKET_DIR)
+    return parser.parse_args()
+
+
+def make_bot():
+    if TELEGRAM_API_SERVER is not None:
+        return Bot(token=BOT_TOKEN, server=TelegramAPIServer.from_base(TELEGRAM_API_SERVER))
+    return Bot(token=BOT_TOKEN)
+
+
+def run_sharded(args):
+    workers = []
+    for index in range(args.shards + 1):
+        workers.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), "--shard", str(index),
+                                         "--shards", str(args.shards), "--socket-dir", args.socket_dir]))
+    router = Router(make_bot(), [socket_path(args.socket_dir, index) for index in range(args.shards + 1)],
+                    WEBHOOK_SECRET)
+    try:
+        run_router(router, host=args.host, port=args.port, path=args.path, url=args.url)
+    finally:
+        for worker in workers:
+            worker.send_signal(signal.SIGINT)
+        for worker in workers:
+            try:
+                worker.wait(30)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+
+
+def create_dispatcher(bot, store, shard_index=None, shards=0, outbox=None):
+    # every handler of the bot, returned with the hooks that start and stop its background work
+    if outbox is None and shard_index is None:
+        outbox = Outbox(bot)
+    elif outbox is None:
+        # every process sends on its own, together they keep to the bot's limit
+        outbox = Outbox(bot, global_rate=GLOBAL_RATE / (shards + 1))
+    dp = Dispatcher(bot, storage=SQLiteStorage(store))
+    users = set()
+    names = {BOT_NAME}
+    game_builders: Dict[int, GameBuilder] = dict()
+    registry = GameRegistry(store)
+    shard = None if shard_index is None else Shard(shard_index, shards, registry, store, GAME_STATES)
+    bot_player = BotPlayer(BOT_THINK_TIME, BOT_PROCESSES, KOMI)
+    boards = BoardExecutor(BOARD_EXECUTOR, BOARD_WORKERS)
+    store.busy = boards.busy
+    locks = GameLocks()
+    metrics_server = None
+    pictures = ImageCache(IMAGE_CACHE_SIZE)
+    profiling = Profiling(PROFILE_DIR)
+    # moves the bot is thinking about, and games whose last bot move failed
+    bot_moves = set()
+    stalled_bot_games = set()
+
+    dp.middleware.setup(MetricsMiddleware(REGISTRY))
+    REGISTRY.gauge("gobot_live_games", "Games being played", lambda: len(registry.live_games))
+    REGISTRY.gauge("gobot_hydrated_games", "Games with their board and chat in memory",
+                   lambda: sum(1 for the_game in registry.live_games.values() if the_game.is_hydrated()))
+    REGISTRY.gauge("gobot_open_games", "Games waiting for an opponent", lambda: len(registry.new_games))
+    REGISTRY.gauge("gobot_outbox_depth", "Messages waiting to be sent", outbox.depth)
+    REGISTRY.gauge("gobot_outbox_chats", "Chats with messages waiting to be sent", lambda: len(outbox.pending))
+    REGISTRY.gauge("gobot_game_locks", "Games with an update running or waiting", lambda: len(locks))
+    REGISTRY.gauge("gobot_board_pictures", "Board pictures in the cache", lambda: len(pictures))
+    REGISTRY.gauge("gobot_busy_boards", "Games with a board operation running", lambda: len(boards.busy))
+    REGISTRY.histogram_family("gobot_board_queue_seconds", "Time board operations wait for the game's previous one",
+                              "op", boards.waiting)
+    REGISTRY.histogram_family("gobot_board_executor_seconds", "Board operations on the executor, pickling included",
+                              "op", boards.running)
+
+    def notify(chat_id, text, reply_markup=None):
+        if chat_id != BOT_ID:
+            outbox.send(chat_id, text, reply_markup=reply_markup)
+
+    def per_game(handler):
+        # updates of one game run one at a time, the game may have ended while this one waited
+        @functools.wraps(handler)
+        async def wrapper(message: types.Message, state: FSMContext):
+            game_name = (await state.get_data())['current_game']
+            async with locks.hold(game_name):
+                if game_name not in registry.live_games:
+                    await state.set_state(LOGGED_STATE)
+                    await message.answer(f"The game {game_name} has ended", reply_markup=logged_keyboard)
+                    return
+                await handler(message, state)
+        return wrapper
 
+    async def bot_move(the_game):
+        await boards.settled(the_game)
+        board = the_game.board
+        position = board.hash
+        move = await bot_player.choose_move(board)
+        async with locks.hold(the_game.game.name):
+            await play_bot_move(the_game, move, position)
+
+    async def play_bot_move(the_game, move, position):
+        game_name = the_game.game.name
+        if registry.live_games.get(game_name, None) is not the_game:
+            return
+        board = (await registry.hydrate(the_game)).board
+        if board.end or board.current_move != board.WHITE or board.hash != position:
+            return
+        player_id = the_game.game.creator_id
+        result = Board.FINE
+        if move != PASS:
+            result = await boards.run(the_game, Board.make_move, board.notation(board.stone(move)), Board.WHITE)
+        if move == PASS or result != Board.FINE:
+            result = await boards.run(the_game, Board.passing, Board.WHITE)
+            if result == Board.NOT_YOUR_TURN:
+                return
+            registry.save(the_game)
+            picture = await display(the_game)
+            if result == Board.GAME_END:
+                outbox.send(player_id, f"{BOT_NAME} has also passed in game '{game_name}'.\n"
+                                       f"{take_off_proposal(the_game.board, picture)}")
+            else:
+                outbox.send(player_id, f"{BOT_NAME} has passed in game '{game_name}'")
+            await update_views(the_game)
+            return
+        registry.save(the_game)
+        await send_board(the_game, player_id, f"{BOT_NAME} made a move in the game {game_name}",
+                         reply_markup=make_move_keyboard)
+        await update_views(the_game)
+
+    def schedule_bot_move(the_game):
+        if the_game.is_bot_game():
+            task = asyncio.ensure_future(bot_move(the_game))
+            bot_moves.add(task)
+            task.add_done_callback(functools.partial(bot_move_done, the_game))
+
+    def bot_move_done(the_game, task):
+        bot_moves.discard(task)
+        if task.cancelled() or task.exception() is None:
+            return
+        game_name = the_game.game.name
+        log.error("%s could not move in the game %s", BOT_NAME, game_name, exc_info=task.exception())
+        # the game waits on the bot's turn, the player's next move starts it again
+        stalled_bot_games.add(game_name)
+        notify(the_game.game.creator_id, f"{BOT_NAME} could not make a move in the game {game_name}. "
+                                         f"Enter a move to let it try again")
+
+    def retry_bot_move(the_game):
+        if the_game.game.name in stalled_bot_games:
+            stalled_bot_games.discard(the_game.game.name)
+            schedule_bot_move(the_game)
+
+    async def display(the_game):
+        # the text board is a cached lookup, it is read on the loop once the game's moves are done
+        await boards.settled(the_game)
+        return the_game.board.display()
+
+    async def board_view(the_game, view):
+        await boards.settled(the_game)
+        board = the_game.board
+        picture = board.display() if board.size > VIEW_SIZE else None
+        return board_view_text(the_game, view, picture), board_keyboard(board, view.top, view.left)
 
-class Game:
-    def __init__(self, creator, creator_id, name, size):
-        self.creator = creator
-        self.creator_id = creator_id
-        self.name = name
-        self.size = size
-
-    def __str__(self):
-        return f"{self.creator}: {self.name}\n    size: {self.size}x{self.size}"
-
-
-class Chat:
-    def __init__(self):
-        self.messages = []
-
-    def add(self, message: str, sender: str):
-        self.messages.append(f"{sender}: {message}")
-
-    def display(self):
-        text = "\n".join(self.messages)
-        if text == "":
-            text = "Chat history si empty"
-        return text
-
-
-class LiveGame:
-    def __init__(self, game, opponent, opponent_id):
-        self.game = game
-        self.opponent = opponent
-        self.opponent_id = opponent_id
-        self.board = Board(self.game.size)
-        self.chat = Chat()
-
-    def __str__(self):
-        return f"{self.game.name}: {self.game.creator} vs {self.opponent} \n" \
-               f"    {self.game.size}x{self.game.size}. {self.current_player()}'s move"
-
-    def other_player(self, player_id):
-        if player_id == self.opponent_id:
-            return self.game.creator_id
+    async def board_picture(the_game):
+        # the same position is rendered once, and uploaded once while it stays in the cache
+        await boards.settled(the_game)
+        board = the_game.board
+        key = (board.size, board.hash)
+        picture = pictures.get(key)
+        if picture is None:
+            picture = pictures.put(key, await boards.read(the_game, render_png))
+        return picture
+
+    async def send_board(the_game, player_id, text, reply_markup=None):
+        # a notice with the board the way the player wants it, a board message with buttons shows it already
+        if player_id == BOT_ID:
+            return
+        if player_id in the_game.views:
+            notify(player_id, text, reply_markup=reply_markup)
+        elif player_id in the_game.picture_players:
+            outbox.send_photo(player_id, await board_picture(the_game), caption=text, reply_markup=reply_markup)
         else:
-            return self.opponent_id
+            notify(player_id, text, reply_markup=reply_markup)
+            notify(player_id, await display(the_game))
 
-    def is_creator(self, uid):
-        return uid == self.game.creator_id
-
-    def current_player(self):
-        if self.board.current_move == self.board.BLACK:
-            return self.game.creator
-        else:
-            return self.opponent
-
-    def result(self):
-        return f"The game {self.game.name} has ended. \n" \
-               f"{self.game.creator}: {self.board.black_score} vs {self.opponent}: {self.board.white_score} \n" \
-               f"{'White' if self.board.white_score >= self.board.black_score else 'Black'} won"
-
-
-class GameBuilder:
-    def __init__(self):
-        self._creator = ''
-        self._creator_id = -1
-        self._name = 'Friendly game'
-        self._size = 19
-
-    def build(self):
-        return Game(self._creator, self._creator_id, self._name, self._size)
-
-    def creator(self, creator):
-        self._creator = creator
-        return self
-
-    def creator_id(self, creator_id):
-        self._creator_id = creator_id
-        return self
-
-    def name(self, name):
-        self._name = name
-        return self
-
-    def size(self, size):
-        self._size = size
-        return self
-
-
-class Board:
-    WHITE_CIRCLE = '⚪️'
-    BLACK_CIRCLE = '⚫️'
-    BROWN_CIRCLE = '🟠'
-    EMPTY = ' '
-
-    BLACK = 1
-    WHITE = 2
-
-    FINE = 100
-    INVALID_POSITION = 200
-    PLACE_TAKEN = 201
-    ILLEGAL_SUICIDE = 202
-    ILLEGAL_KO = 203
-    INVALID_NOTATION = 204
-    GAME_END = 300
-
-    def __init__(self, size):
-        self.board_array = np.zeros((size, size))
-        self.groups_array = np.zeros((size, size))
-        self.group_dict = dict()
-        self.size = size
-        self.current_move = Board.BLACK
-        self.black_score = 0
-        self.white_score = 0
-        self.passes = 0
-        self.end = False
-        self.take_off_list = TakeOffList()
-
-    def make_move(self, move: str):
-        if len(move) not in (2, 3):
-            return self.INVALID_NOTATION
-
-        letter = move[0]
-        digit = move[1:]
-        if letter not in string.ascii_lowercase:
-            return self.INVALID_NOTATION
-        if not digit.isdigit():
-            return self.INVALID_NOTATION
-        move = string.ascii_lowercase.find(letter), int(digit)
-        if move[0] >= self.size:
-            return self.INVALID_POSITION
-        if move[1] >= self.size:
-            return self.INVALID_POSITION
-        if self.board_array[move] != 0:
-            return self.PLACE_TAKEN
-
-        self.board_array[move] = self.current_move
-        self.update_groups()
-        self.take_dead_stones()
-
-        if self.current_move == self.BLACK:
-            self.current_move = self.WHITE
-        else:
-            self.current_move = self.BLACK
-
-        self.passes = 0
-
-        return self.FINE
-
-    def display(self):
-        result_array = []
-        for i, row in enumerate(self.board_array):
-            text_array = []
-            for cell in row:
-                if cell == 0:
-                    text_array.append(self.BROWN_CIRCLE)
-                if cell == self.BLACK:
-                    text_array.append(self.BLACK_CIRCLE)
-                if cell == self.WHITE:
-                    text_array.append(self.WHITE_CIRCLE)
-            text_array.append(string.ascii_uppercase[i])
-            result_array.append("".join(text_array))
-        separator = "\n"
-        numbers = []
-        for i in range(self.size):
-            num = str(i)
-            numbers.append(num)
-            if i < 10:
-                numbers.append("  ")
-            numbers.append(" "*(3 - len(num)))
-
-        result_array.insert(0, "".join(numbers))
-        return separator.join(result_array)
-
-    def update_groups(self):
-        self.groups_array = np.zeros((self.size, self.size))
-        self.group_dict = dict()
-        group_n = 0
-        for i in range(self.size):
-            for j in range(self.size):
-                if self.groups_array[i][j] != 0:
-                    continue
-                group_n += 1
-                stone = (i, j)
-                color = self.board_array[stone]
-                self.group_dict[group_n] = Group(group_n, color)
-                self.fill_group(stone, color, group_n)
-
-    def fill_group(self, stone, color, group_n):
-        try:
-            group = self.group_dict[group_n]
-            if self.groups_array[stone] == group_n:
-                return
-            if self.board_array[stone] == color:
-                self.groups_array[stone] = group_n
-                group.add_stone(stone)
-                for s in self.stone_neighbours(stone):
-                    self.fill_group(s, color, group_n)
-            else:
-                neigh_group = self.group_dict.get(self.groups_array[stone], None)
-                if neigh_group is None:
-                    return
-                group.add_neighbour(neigh_group)
-                neigh_group.add_neighbour(group)
-        except IndexError:
-            print("Index error occurred")
-
-    def stone_neighbours(self, stone):
-        stones = [(stone[0]-1, stone[1]),
-                  (stone[0], stone[1]-1),
-                  (stone[0]+1, stone[1]),
-                  (stone[0], stone[1]+1)]
-        for s in stones:
-            if s[0] >= self.size or s[0] < 0:
-                stones.remove(s)
-            elif s[1] >= self.size or s[1] < 0:
-                stones.remove(s)
-        return stones
-
-    def take_dead_stones(self):
-        for group in self.group_dict.values():
-            if group.color == 0:
-                continue
-            if group.is_dead():
-                for stone in group.stones:
-                    color = self.board_array[stone]
-                    if color == self.BLACK:
-                        self.black_score += 1
-                    elif color == self.WHITE:
-                        self.white_score += 1
-                    self.board_array[stone] = 0
-
-    def passing(self):
-        self.passes += 1
-        if self.passes == 2:
-            self.end = True
-            return self.GAME_END
-        if self.current_move == self.BLACK:
-            self.current_move = self.WHITE
+    async def show_board(message: types.Message, the_game):
+        if message.chat.id in the_game.picture_players:
+            outbox.send_photo(message.chat.id, await board_picture(the_game))
         else:
-            self.current_move = self.BLACK
-        return self.FINE
-
-    def mark_dead_stone(self, move, color):
-        if len(move) not in (2, 3):
-            return self.INVALID_NOTATION
-
-        letter = move[0]
-        digit = move[1:]
-
-        if not self.end:
-            raise RuntimeError("Trying to take off stones before the end of the game")
-        if letter not in string.ascii_lowercase:
-            return self.INVALID_NOTATION
-        if not digit.isdigit():
-            return self.INVALID_NOTATION
-        move = string.ascii_lowercase.find(letter), int(digit)
-        if move[0] >= self.size:
-            return self.INVALID_POSITION
-        if move[1] >= self.size:
-            return self.INVALID_POSITION
-        if self.board_array[move] != 0:
-            if color == self.BLACK:
-                self.take_off_list.black_add(move)
-            if color == self.WHITE:
-                self.take_off_list.white_add(move)
-            return self.PLACE_TAKEN
-        return self.FINE
-
-    def end_game(self):
-        dead_groups = set()
-        for stone in self.take_off_list.black:
-            dead_groups.add(self.group_dict[self.groups_array[stone]])
-        for stone in self.take_off_list.white:
-            dead_groups.add(self.group_dict[self.groups_array[stone]])
-
-        for group in dead_groups:
-            for stone in group.stones:
-                color = self.board_array[stone]
-                if color == self.BLACK:
-                    self.white_score += 1
-                elif color == self.WHITE:
-                    self.black_score += 1
-                self.board_array[stone] = 0
-
-        self.update_groups()
-
-        for group in self.group_dict.values():
-            if group.color != 0:
-                continue
-            neigh_colors = set()
-            for neighbour in group.neighbours:
-                neigh_colors.add(neighbour.color)
-            if len(neigh_colors) == 1:
-                color = neigh_colors.pop()
-                if color == self.BLACK:
-                    self.black_score += len(group.stones)
-                elif color == self.WHITE:
-                    self.white_score += len(group.stones)
-
-
-class Group:
-    def __init__(self, group_id, color):
-        self.group_id = group_id
-        self.color = color
-        self.stones = set()
-        self.neighbours = set()
-
-    def add_stone(self, stone):
-        self.stones.add(stone)
-
-    def add_neighbour(self, neighbour):
-        self.neighbours.add(neighbour)
-
-    def is_dead(self):
-        dead = True
-        for n in self.neighbours:
-            if n.color == 0:
-                dead = False
-                break
-        return dead
-
-
-class TakeOffList:
-    def __init__(self):
-        self.black = []
-        self.white = []
-        self.black_agree = False
-        self.white_agree = False
-        self.black_ready = False
-        self.white_ready = False
-
-    def black_add(self, stone):
-        self.black.append(stone)
-
-    def white_add(self, stone):
-        self.white.append(stone)
+            await message.answer(await display(the_game))
 
+    async def update_views(the_game):
+        # the board messages with buttons are edited instead of sending the board again
+        for player_id, view in the_game.views.items():
+            text, keyboard = await board_view(the_game, view)
+            outbox.edit(player_id, view.message_id, text, reply_markup=keyboard)
 
-def main():
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher(bot, storage=MemoryStorage())
-    users = set()
-    names = set()
-    new_games: Dict[str, Game] = dict()
-    game_builders: Dict[int, GameBuilder] = dict()
-    live_games: Dict[str, LiveGame] = dict()
+    async def play_move(the_game, uid, name, move):
+        # a move typed in the move menu or tapped on a board message
+        await boards.settled(the_game)
+        board = the_game.board
+        color = board.WHITE
+        if the_game.is_creator(uid):
+            color = board.BLACK
+        if the_game.opponent_id == the_game.game.creator_id:
+            color = board.current_move
+        # the turn is checked again when the move is played, another one may be queued before it
+        result = await boards.run(the_game, Board.make_move, move, color)
+        if result == Board.NOT_YOUR_TURN:
+            retry_bot_move(the_game)
+        if result == Board.FINE:
+            opponent_id = the_game.other_player(uid)
+            registry.save(the_game)
+            await send_board(the_game, opponent_id, f"{name} made a move in the game {the_game.game.name}",
+                             reply_markup=make_move_keyboard)
+            await update_views(the_game)
+            schedule_bot_move(the_game)
+        return result
+
+    async def send_profile(chat_id, path, report):
+        notify(chat_id, report)
+        await bot.send_document(chat_id, types.InputFile(path))
+
+    @dp.message_handler(commands=['profile'], chat_id=ADMIN_IDS, state='*')
+    async def profile_handler(message: types.Message):
+        # /profile [seconds], samples this process while it keeps serving and sends the stacks when done
+        args = message.get_args()
+        if args and not args.isdigit():
+            await message.answer("Usage: /profile [seconds]")
+            return
+        seconds = min(int(args or 30), MAX_SECONDS)
+        if profiling.running():
+            await message.answer("A profile is already being taken")
+            return
+        profiling.start(seconds, functools.partial(send_profile, message.chat.id))
+        await message.answer(f"Profiling process {os.getpid()} for {seconds} s")
 
     @dp.message_handler(commands=['guide'], state='*')
     async def guide_handler(message: types.Message, state: FSMContext):
@@ -396,6 +388,9 @@ def main():
           Enter /make_move to make a move
             You will be sent to a menu, where you can enter /board to look at the boar
             Moves should be a letter, followed by a number i.e. a0, e4 or f10
+          Enter /buttons to get a board with buttons, tap a point to make a move there
+            The board message is updated after every move, big boards show a part of it that arrows move
+          Enter /pictures to get boards of the game as pictures instead of text, enter it again for text
           Enter /reign to resign
           Enter /pass to pass
             After both players pass, the game goes into the take off stage:
@@ -420,6 +415,9 @@ def main():
         После ввода комманды /play вы находитесь в меню игры:
           Введите /chat чтобы открыть чат со своим противником. В чате можно открыть историю чата, введя /history
           Ходы должны быть в формате: одна латинская буква, а затем число, например a0, e4 или f10
+          Введите /buttons чтобы получить доску с кнопками, нажмите на пересечение чтобы сходить туда
+            Это сообщение обновляется после каждого хода, на больших досках видна часть доски, которую двигают стрелки
+          Введите /pictures чтобы получать доску этой игры картинкой вместо текста, введите ещё раз для текста
         Введите /resign чтобы сдатся
         Введите /pass чтобы спасовать
             После того, как оба игрока спасуют, игра переходит в стадию снятия камней:
@@ -477,10 +475,7 @@ def main():
     @dp.message_handler(state=NEW_GAME_NAME_STATE)
     async def new_game_name_set(message: types.Message, state: FSMContext):
         game_name = message.text
-        if game_name in new_games.keys():
-            await message.answer("Game with such name already exists, Enter new name ")
-            return
-        if game_name in live_games.keys():
+        if registry.name_taken(game_name):
             await message.answer("Game with such name already exists, Enter new name ")
             return
 
@@ -505,7 +500,7 @@ def main():
         else:
             await message.answer("Y/N")
 
-    @dp.message_handler(commands=['cancel_new'], state=NEW_GAME_SIZE_STATE)
+    @dp.message_handler(commands=['cancel_new'], state=[NEW_GAME_SIZE_STATE, NEW_GAME_OPPONENT_STATE])
     async def cancel_new_game_handler(message: types.Message, state: FSMContext):
         await state.set_state(NEW_GAME_SIZE_CANCELLATION_STATE)
         await message.answer("Are you sure? \n Y/N", reply_markup=y_n_keyboard)
@@ -537,25 +532,39 @@ def main():
             await message.answer("Size can be only 9, 13 or 19")
             return
         uid = message.chat.id
-        game_builder: GameBuilder = game_builders[uid]
-        game = game_builder.size(size).build()
-        game_builders.pop(uid)
-        new_games[game.name] = game
-        await message.answer("The game has been created",
-                             reply_markup=logged_keyboard)
+        game_builders[uid].size(size)
+        await message.answer("Do you want to play against a human or the computer?", reply_markup=opponent_keyboard)
+        await state.set_state(NEW_GAME_OPPONENT_STATE)
+
+    @dp.message_handler(state=NEW_GAME_OPPONENT_STATE)
+    async def new_game_opponent(message: types.Message, state: FSMContext):
+        text = message.text.lower()
+        if text not in ("human", "computer"):
+            await message.answer("Human/Computer", reply_markup=opponent_keyboard)
+            return
+        uid = message.chat.id
+        game_builder: GameBuilder = game_builders.pop(uid)
+        game = game_builder.bot(text == "computer").build()
+        if game_builder.is_bot():
+            registry.start_bot_game(game)
+            await message.answer(f"The game against {BOT_NAME} has been created, you play black. "
+                                 f"Enter /play to start", reply_markup=logged_keyboard)
+        else:
+            registry.add(game)
+            await message.answer("The game has been created",
+                                 reply_markup=logged_keyboard)
         await state.set_state(LOGGED_STATE)
 
     @dp.message_handler(commands=['list'], state=LOGGED_STATE)
     async def list_handler(message: types.Message, state: FSMContext):
-        text = "\n".join([f"{i + 1}) {str(game)}" for i, game in enumerate(new_games.values())])
-        if len(new_games) == 0:
+        text = "\n".join([f"{i + 1}) {str(game)}" for i, game in enumerate(registry.open_games())])
+        if len(text) == 0:
             text = "There is no games yet"
         await message.answer(text, reply_markup=logged_keyboard)
 
     @dp.message_handler(commands=['list_my'], state=LOGGED_STATE)
     async def list_my(message: types.Message, state: FSMContext):
-        name = (await state.get_data())["name"]
-        my_games = filter(lambda game: True if game.creator == name else False, new_games.values())
+        my_games = registry.open_games_by_creator(message.chat.id)
         text = "\n".join((f"{i + 1}) {str(game)}" for i, game in enumerate(my_games)))
         if len(text) == 0:
             text = "There is no your games yet"
@@ -564,16 +573,13 @@ def main():
     @dp.message_handler(commands=['list_my_live'], state=LOGGED_STATE)
     async def list_my_live(message: types.Message, state: FSMContext):
         name = (await state.get_data())["name"]
-        my_games = await live_games_by_name(name)
+        my_games = registry.live_games_by_name(name)
+        await registry.refresh_turns(my_games)
         text = "\n".join((f"{i + 1}) {str(game)}" for i, game in enumerate(my_games)))
         if len(text) == 0:
             text = "There is no your live games yet"
         await message.answer(text, reply_markup=logged_keyboard)
 
-    async def live_games_by_name(name):
-        return filter(lambda game: True if (game.game.creator == name or game.opponent == name) else False,
-                      live_games.values())
-
     @dp.message_handler(commands=['delete_game'], state=LOGGED_STATE)
     async def delete_handler(message: types.Message, state: FSMContext):
         await state.set_state(GAME_DELETION_STATE)
@@ -590,7 +596,7 @@ def main():
     async def delete_game_name(message: types.Message, state: FSMContext):
         name = message.text
         uid = message.chat.id
-        game = new_games.get(name, None)
+        game = registry.open_game(name)
         if game is None:
             await message.answer("Such game does not exist. Enter /cancel_del to cancel the deletion")
             return
@@ -606,8 +612,11 @@ def main():
         text = message.text.lower()
         if text == "y":
             game_name = (await state.get_data())['game_to_delete']
-            new_games.pop(game_name)
-            await message.answer("Game deleted", reply_markup=logged_keyboard)
+            if registry.open_game(game_name) is None:
+                await message.answer("Someone has already joined this game", reply_markup=logged_keyboard)
+            else:
+                registry.delete(game_name)
+                await message.answer("Game deleted", reply_markup=logged_keyboard)
             await state.set_state(LOGGED_STATE)
         elif text == "n":
             await state.set_state(LOGGED_STATE)
@@ -630,15 +639,15 @@ def main():
     async def join_game_name(message: types.Message, state: FSMContext):
         game_name = message.text
         name = (await state.get_data())['name']
-        if game_name not in new_games.keys():
+        live_game = registry.join(game_name, name, message.chat.id)
+        if live_game is None:
             await message.answer("Such game does not exist. Enter /cancel_join to cancel joining")
             return
-        game = new_games.pop(game_name)
-        live_games[game_name] = LiveGame(game, name, message.chat.id)
+        game = live_game.game
         await message.answer("You connected to the game. Enter /play to start playing it",
                              reply_markup=logged_keyboard)
-        await bot.send_message(game.creator_id, f"Player {name} connected to your game {game_name}",
-                               reply_markup=logged_keyboard)
+        notify(game.creator_id, f"Player {name} connected to your game {game_name}",
+               reply_markup=logged_keyboard)
         await state.set_state(LOGGED_STATE)
 
     @dp.message_handler(state=JOIN_CANCELLATION_STATE)
@@ -670,7 +679,8 @@ def main():
     async def game_choice(message: types.Message, state: FSMContext):
         game_name = message.text
         name = (await state.get_data())['name']
-        the_game = await live_game_by_name(game_name, name)
+        # the board is loaded by the worker owning the game when the player makes a move
+        the_game = registry.find_live_game(game_name, name)
         if the_game is None:
             await message.answer("You didn't join game with such name. Enter /cancel_play to cancel")
             return
@@ -696,14 +706,38 @@ def main():
                              reply_markup=chat_keyboard)
 
     @dp.message_handler(commands=['history'], state=GAME_CHAT_STATE)
+    @per_game
     async def history_handler(message: types.Message, state: FSMContext):
         player_data = await state.get_data()
         game_name = player_data['current_game']
         name = player_data['name']
-        the_game = await live_game_by_name(game_name, name)
-        chat = the_game.chat
-        await message.answer(chat.display(),
-                             reply_markup=chat_keyboard)
+        the_game = await registry.live_game(game_name, name)
+        page = the_game.chat.page_count() - 1
+        await message.answer(await registry.chat_page(the_game, page),
+                             reply_markup=history_keyboard(page, the_game.chat.page_count()))
+
+    @dp.callback_query_handler(text_startswith=HISTORY_PREFIX, state='*')
+    async def history_page(query: types.CallbackQuery, state: FSMContext):
+        # the buttons under a /history message, the message is edited to show the chosen page
+        page = query.data[len(HISTORY_PREFIX):]
+        if await state.get_state() != GAME_CHAT_STATE or not page.isdigit():
+            await query.answer("Open the game chat with /chat to see its history")
+            return
+        player_data = await state.get_data()
+        game_name = player_data['current_game']
+        async with locks.hold(game_name):
+            the_game = await registry.live_game(game_name, player_data['name'])
+            if the_game is None:
+                await query.answer(f"The game {game_name} has ended")
+                return
+            pages = the_game.chat.page_count()
+            page = min(int(page), pages - 1)
+            text = await registry.chat_page(the_game, page)
+        try:
+            await query.message.edit_text(text, reply_markup=history_keyboard(page, pages))
+        except MessageNotModified:
+            pass
+        await query.answer()
 
     @dp.message_handler(commands=['close_chat'], state=GAME_CHAT_STATE)
     async def close_chat(message: types.Message, state: FSMContext):
@@ -711,25 +745,28 @@ def main():
         await message.answer("You closed the chat", reply_markup=game_keyboard)
 
     @dp.message_handler(state=GAME_CHAT_STATE)
+    @per_game
     async def chatting_handler(message: types.Message, state: FSMContext):
         player_data = await state.get_data()
         text = message.text
         uid = message.chat.id
         game_name = player_data['current_game']
         name = player_data['name']
-        the_game = await live_game_by_name(game_name, name)
+        the_game = await registry.live_game(game_name, name)
         opponent_id = the_game.other_player(uid)
         chat = the_game.chat
         chat.add(text, name)
-        await bot.send_message(opponent_id, f"{name}: {text}")
+        registry.save(the_game)
+        notify(opponent_id, f"{name}: {text}")
 
     @dp.message_handler(commands=['board'], state=GAME_STATE)
+    @per_game
     async def display_board(message: types.Message, state: FSMContext):
         player_data = await state.get_data()
         game_name = player_data['current_game']
         name = player_data['name']
-        the_game = await live_game_by_name(game_name, name)
-        await message.answer(the_game.board.display())
+        the_game = await registry.live_game(game_name, name)
+        await show_board(message, the_game)
 
     @dp.message_handler(commands=['make_move'], state=GAME_STATE)
     async def move_handler(message: types.Message, state: FSMContext):
@@ -743,65 +780,110 @@ def main():
         await state.set_state(GAME_STATE)
 
     @dp.message_handler(commands=['board'], state=GAME_MOVE_STATE)
+    @per_game
     async def display_board(message: types.Message, state: FSMContext):
         player_data = await state.get_data()
         game_name = player_data['current_game']
         name = player_data['name']
-        the_game = await live_game_by_name(game_name, name)
-        await message.answer(the_game.board.display())
+        the_game = await registry.live_game(game_name, name)
+        await show_board(message, the_game)
 
     @dp.message_handler(state=GAME_MOVE_STATE)
+    @per_game
     async def make_move(message: types.Message, state: FSMContext):
         move = message.text
         player_data = await state.get_data()
         uid = message.chat.id
         game_name = player_data['current_game']
         name = player_data['name']
-        the_game = await live_game_by_name(game_name, name)
-        opponent_id = the_game.other_player(uid)
+        the_game = await registry.live_game(game_name, name)
         board = the_game.board
         if board.end:
             await message.answer("The game is in taking off stage. Enter /take_off",
                                  reply_markup=game_keyboard)
             await state.set_state(GAME_STATE)
-        color = board.WHITE
-        if the_game.is_creator(uid):
-            color = board.BLACK
-        if the_game.opponent_id == the_game.game.creator_id:
-            color = board.current_move
-        if color != board.current_move:
-            await message.answer("It's not your turn",
-                                 reply_markup=make_move_keyboard)
-            return
-        result = board.make_move(move)
-        if result == board.INVALID_NOTATION:
-            await message.answer("Move should be letter and a number without a space i.e a0, f10 or e3",
+        result = await play_move(the_game, uid, name, move)
+        if result in MOVE_ERRORS:
+            await message.answer(MOVE_ERRORS[result],
                                  reply_markup=make_move_keyboard)
-        elif result == board.INVALID_POSITION:
-            await message.answer("You are trying to place a stone outside of the board",
-                                 reply_markup=make_move_keyboard)
-        elif result == board.PLACE_TAKEN:
-            await message.answer("There is already a stone there",
-                                 reply_markup=make_move_keyboard)
-        elif result == board.ILLEGAL_SUICIDE:
-            await message.answer("This move kills your stones, it's illegal",
-                                 reply_markup=make_move_keyboard)
-        elif result == board.ILLEGAL_KO:
-            await message.answer("This move repeats positions, first make a move somewhere else",
-                                 reply_markup=make_move_keyboard)
-        elif result == board.FINE:
-            await bot.send_message(opponent_id, f"{name} made a move in the game {game_name}",
-                                   reply_markup=make_move_keyboard)
-            await bot.send_message(opponent_id, board.display())
-        else:
+        elif result != Board.FINE:
             raise NotImplementedError(f"Unexpected board return code: {result}")
 
+    @dp.message_handler(commands=['pictures'], state=[GAME_STATE, GAME_MOVE_STATE])
+    @per_game
+    async def pictures_handler(message: types.Message, state: FSMContext):
+        # switches between pictures and text for the boards of this game
+        player_data = await state.get_data()
+        uid = message.chat.id
+        the_game = await registry.live_game(player_data['current_game'], player_data['name'])
+        if uid in the_game.picture_players:
+            the_game.picture_players.discard(uid)
+            await message.answer("Boards of this game will be sent as text")
+        elif not pictures_available():
+            await message.answer("Pictures of the board are not available, boards stay text")
+        else:
+            the_game.picture_players.add(uid)
+            await message.answer("Boards of this game will be sent as pictures, enter /pictures again for text")
+            await show_board(message, the_game)
+
+    @dp.message_handler(commands=['buttons'], state=[GAME_STATE, GAME_MOVE_STATE])
+    @per_game
+    async def buttons_handler(message: types.Message, state: FSMContext):
+        # one board message per player and game, later moves edit it
+        player_data = await state.get_data()
+        uid = message.chat.id
+        the_game = await registry.live_game(player_data['current_game'], player_data['name'])
+        start = max(0, (the_game.board.size - VIEW_SIZE) // 2)
+        view = BoardView(None, start, start)
+        text, keyboard = await board_view(the_game, view)
+        sent = await message.answer(text, reply_markup=keyboard)
+        view.message_id = sent.message_id
+        previous = the_game.views.get(uid, None)
+        the_game.views[uid] = view
+        if previous is not None:
+            outbox.edit(uid, previous.message_id, "This board has moved to a newer message")
+
+    @dp.callback_query_handler(text_startswith=[MOVE_PREFIX, VIEW_PREFIX], state='*')
+    async def board_button(query: types.CallbackQuery, state: FSMContext):
+        player_data = await state.get_data()
+        game_name = player_data.get('current_game', None)
+        if game_name is None or await state.get_state() not in BOARD_VIEW_STATES:
+            await query.answer("Open the game with /play to use its board")
+            return
+        uid = query.from_user.id
+        answer = None
+        async with locks.hold(game_name):
+            the_game = await registry.live_game(game_name, player_data['name'])
+            if the_game is None:
+                await query.answer(f"The game {game_name} has ended")
+                return
+            view = the_game.views.get(uid, None)
+            if view is None or query.message is None or view.message_id != query.message.message_id:
+                await query.answer("This board is out of date, enter /buttons for a new one")
+                return
+            board = the_game.board
+            if query.data.startswith(VIEW_PREFIX):
+                # the arrows under a big board move its window
+                last = board.size - VIEW_SIZE
+                top, _, left = query.data[len(VIEW_PREFIX):].partition(":")
+                if top.isdigit() and left.isdigit():
+                    view.top, view.left = min(int(top), last), min(int(left), last)
+                text, keyboard = await board_view(the_game, view)
+                outbox.edit(uid, view.message_id, text, reply_markup=keyboard)
+            elif board.end:
+                answer = "The game is in taking off stage. Enter /take_off"
+            else:
+                result = await play_move(the_game, uid, player_data['name'], query.data[len(MOVE_PREFIX):])
+                answer = MOVE_ERRORS.get(result, None)
+        await query.answer(answer)
+
     @dp.message_handler(commands=['resign'], state=GAME_STATE)
     async def resign_handler(message: types.Message, state: FSMContext):
         await state.set_state(GAME_RESIGN_STATE)
         await message.answer("Are you sure? Y/N", reply_markup=y_n_keyboard)
 
     @dp.message_handler(state=GAME_RESIGN_STATE)
+    @per_game
     async def resign(message: types.Message, state: FSMContext):
         text = message.text.lower()
         if text == "y":
@@ -809,10 +891,9 @@ def main():
             player_data = await state.get_data()
             game_name = player_data['current_game']
             name = player_data['name']
-            the_game = await live_game_by_name(game_name, name)
+            the_game = registry.resign(game_name, uid)
             opponent_id = the_game.other_player(uid)
-            await bot.send_message(opponent_id, f"{name} has resigned in game '{game_name}', you won!")
-            live_games.pop(game_name)
+            notify(opponent_id, f"{name} has resigned in game '{game_name}', you won!")
             await state.set_state(LOGGED_STATE)
             await message.answer("You resigned the game", reply_markup=logged_keyboard)
         if text == "n":
@@ -823,12 +904,14 @@ def main():
             await message.answer("Y/N", reply_markup=y_n_keyboard)
 
     @dp.message_handler(commands=['pass'], state=GAME_STATE)
+    @per_game
     async def pass_handler(message: types.Message, state: FSMContext):
         uid = message.chat.id
         player_data = await state.get_data()
         game_name = player_data['current_game']
         name = player_data['name']
-        the_game = await live_game_by_name(game_name, name)
+        the_game = await registry.live_game(game_name, name)
+        await boards.settled(the_game)
         board = the_game.board
         opponent_id = the_game.other_player(uid)
         color = board.WHITE
@@ -836,31 +919,43 @@ def main():
             color = board.BLACK
         if the_game.opponent_id == the_game.game.creator_id:
             color = board.current_move
-        if color != board.current_move:
+        result = await boards.run(the_game, Board.passing, color)
+        if result == Board.NOT_YOUR_TURN:
+            retry_bot_move(the_game)
             await message.answer("It's not your turn",
                                  reply_markup=make_move_keyboard)
             return
-        result = board.passing()
-        if result == board.FINE:
-            await bot.send_message(opponent_id, f"{name} has passed in game '{game_name}'")
-        elif result == board.GAME_END:
-            await bot.send_message(opponent_id, f"{name} has also passed in game '{game_name}', take off dead stones."
-                                                f"Enter /take_off")
-            await message.answer("Take off the dead stones. Enter /take_off")
+        registry.save(the_game)
+        await update_views(the_game)
+        if result == Board.FINE:
+            notify(opponent_id, f"{name} has passed in game '{game_name}'")
+            schedule_bot_move(the_game)
+        elif result == Board.GAME_END:
+            proposal = take_off_proposal(the_game.board, await display(the_game))
+            notify(opponent_id, f"{name} has also passed in game '{game_name}'.\n{proposal}")
+            await message.answer(proposal)
 
     @dp.message_handler(commands=['take_off'], state=GAME_STATE)
+    @per_game
     async def take_off_handler(message: types.Message, state: FSMContext):
         uid = message.chat.id
         player_data = await state.get_data()
         game_name = player_data['current_game']
         name = player_data['name']
-        the_game = await live_game_by_name(game_name, name)
+        the_game = await registry.live_game(game_name, name)
         board = the_game.board
         if not board.end:
             await message.answer("The game hasn't ended yet")
             return
-        await message.answer("To take off a group enter one of the stones. To end enter /take_off_commit"
-                             " Enter /board to look at the board",
+        board.take_off_list.black_agree = False
+        board.take_off_list.white_agree = False
+        if the_game.is_creator(uid):
+            board.take_off_list.black_ready = False
+        else:
+            board.take_off_list.white_ready = False
+        registry.save(the_game)
+        await message.answer("To take off a group enter one of the stones, enter it again to keep it on the board."
+                             " To end enter /take_off_commit Enter /board to look at the board",
                              reply_markup=ReplyKeyboardRemove())
         await state.set_state(TAKE_OFF_STATE)
 
@@ -870,12 +965,13 @@ def main():
         await state.set_state(GAME_STATE)
 
     @dp.message_handler(commands=['take_off_commit'], state=TAKE_OFF_STATE)
+    @per_game
     async def commit_take_off(message: types.Message, state: FSMContext):
         uid = message.chat.id
         player_data = await state.get_data()
         game_name = player_data['current_game']
         name = player_data['name']
-        the_game = await live_game_by_name(game_name, name)
+        the_game = await registry.live_game(game_name, name)
         board = the_game.board
         color = board.WHITE
         if the_game.is_creator(uid):
@@ -887,25 +983,29 @@ def main():
         if uid == the_game.other_player(uid):
             board.take_off_list.black_ready = True
             board.take_off_list.white_ready = True
+        registry.save(the_game)
         opponent_id = the_game.other_player(uid)
-        await bot.send_message(opponent_id, f"{name} in game: {game_name} has marked the dead stones.")
+        notify(opponent_id, f"{name} in game: {game_name} has marked the dead stones.")
         await message.answer("Ready", reply_markup=game_keyboard)
         await state.set_state(GAME_STATE)
 
     @dp.message_handler(state=TAKE_OFF_STATE)
+    @per_game
     async def take_off_stones(message: types.Message, state: FSMContext):
         text = message.text
         uid = message.chat.id
         player_data = await state.get_data()
         game_name = player_data['current_game']
         name = player_data['name']
-        the_game = await live_game_by_name(game_name, name)
+        the_game = await registry.live_game(game_name, name)
         board = the_game.board
         color = board.WHITE
         if the_game.is_creator(uid):
             color = board.BLACK
-        response = the_game.board.mark_dead_stone(text, color)
-        if response == board.FINE:
+        response = await boards.run(the_game, Board.mark_dead_stone, text, color)
+        if response == board.PLACE_TAKEN:
+            registry.save(the_game)
+        elif response == board.FINE:
             await message.answer("There is no stone there")
         elif response == board.INVALID_POSITION:
             await message.answer("It's outside of the board")
@@ -913,13 +1013,14 @@ def main():
             await message.answer("It should be a letter and a number without of space: i.e. a0, b1 or g14")
 
     @dp.message_handler(commands=['take_off_confirm'], state=GAME_STATE)
+    @per_game
     async def take_off_confirmation_handler(message: types.Message, state: FSMContext):
         text = message.text
         uid = message.chat.id
         player_data = await state.get_data()
         game_name = player_data['current_game']
         name = player_data['name']
-        the_game = await live_game_by_name(game_name, name)
+        the_game = await registry.live_game(game_name, name)
         board = the_game.board
         color = board.WHITE
         if the_game.is_creator(uid):
@@ -932,8 +1033,10 @@ def main():
             if not other_ready:
                 await message.answer("The other player hasn't yet took the dead stones")
                 return
-            await message.answer(f"Other player suggested the following removes:{', '.join(board.take_off_list.white)}"
-                                 f"do you agree? Y/N?", reply_markup=y_n_keyboard)
+            await message.answer(f"Other player suggested the following removes: "
+                                 f"{stones_text(board, board.take_off_list.white)} do you agree? Y/N?",
+                                 reply_markup=y_n_keyboard)
+            await message.answer(await display(the_game))
             await state.set_state(TAKE_OFF_CONFIRM_STATE)
         else:
             if board.take_off_list.white_agree:
@@ -943,12 +1046,14 @@ def main():
             if not other_ready:
                 await message.answer("The other player hasn't yet took the dead stones")
                 return
-            await message.answer(f"Other player suggested the following removes:{', '.join(board.take_off_list.black)}"
-                                 f"do you agree? Y/N?", reply_markup=y_n_keyboard)
-            await message.answer(board.display())
+            await message.answer(f"Other player suggested the following removes: "
+                                 f"{stones_text(board, board.take_off_list.black)} do you agree? Y/N?",
+                                 reply_markup=y_n_keyboard)
+            await message.answer(await display(the_game))
             await state.set_state(TAKE_OFF_CONFIRM_STATE)
 
     @dp.message_handler(state=TAKE_OFF_CONFIRM_STATE)
+    @per_game
     async def take_off_confirmation(message: types.Message, state: FSMContext):
         text = message.text.lower()
         if text == 'y':
@@ -962,7 +1067,7 @@ def main():
         player_data = await state.get_data()
         game_name = player_data['current_game']
         name = player_data['name']
-        the_game = await live_game_by_name(game_name, name)
+        the_game = await registry.live_game(game_name, name)
         board = the_game.board
         color = board.WHITE
         if the_game.is_creator(uid):
@@ -972,33 +1077,79 @@ def main():
             other_agree = board.take_off_list.white_agree
         else:
             other_agree = board.take_off_list.black_agree
-        if uid == the_game.other_player(uid):
+        if uid == the_game.other_player(uid) or the_game.is_bot_game():
             other_agree = True
         if not agree:
-            board.take_off_list = TakeOffList()
-            await bot.send_message(opponent_id, f"{name} in the game {game_name} rejected your take off of stones")
+            await boards.run(the_game, Board.reset_take_off)
+            registry.save(the_game)
+            notify(opponent_id, f"{name} in the game {game_name} rejected your take off of stones")
         else:
             if other_agree:
-                board.end_game()
+                await boards.run(the_game, Board.end_game, SCORING_RULES, KOMI)
                 await message.answer(the_game.result(), reply_markup=logged_keyboard)
-                await bot.send_message(opponent_id, the_game.result())
-                live_games.pop(game_name)
+                notify(opponent_id, the_game.result())
+                registry.finish(game_name)
                 await state.set_state(LOGGED_STATE)
             else:
+                if color == board.BLACK:
+                    board.take_off_list.black_agree = True
+                else:
+                    board.take_off_list.white_agree = True
+                registry.save(the_game)
                 await message.answer("Now wait for the other player")
-                await bot.send_message(opponent_id, f"the player {name} has agreed to your removes in the game {game_name}")
+                notify(opponent_id, f"the player {name} has agreed to your removes in the game {game_name}")
                 await state.set_state(LOGGED_STATE)
 
-    async def live_game_by_name(game_name, name):
-        my_games = await live_games_by_name(name)
-        the_game = None
-        for game in my_games:
-            if game.game.name == game_name:
-                the_game = game
-                break
-        return the_game
+    async def on_startup(dp: Dispatcher):
+        nonlocal metrics_server
+        if METRICS_PORT is not None:
+            metrics_server = await serve_metrics(METRICS_HOST, METRICS_PORT + (shard.index if shard is not None else 0))
+        lobby = shard is not None and shard.index == LOBBY
+        if shard is None or lobby:
+            await registry.load()
+        else:
+            await registry.load(open_games=False, owns=shard.owns)
+        store.start(registry, COLD_GAME_SECONDS)
+        outbox.start()
+        boards.start()
+        if lobby:
+            # the lobby lists games and lets players pick them, the moves are made on the game workers
+            return
+        bot_player.start()
+        # only the games waiting for the bot are loaded, the rest stay on disk until somebody opens them
+        for the_game in await registry.opponent_turns(BOT_ID):
+            if not the_game.board.end and the_game.board.current_move == the_game.board.WHITE:
+                schedule_bot_move(the_game)
+
+    async def on_shutdown(dp: Dispatcher):
+        profiling.close()
+        # unfinished moves are started again on the next startup
+        for task in bot_moves:
+            task.cancel()
+        bot_player.close()
+        boards.close()
+        await outbox.close()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+
+    return dp, shard, on_startup, on_shutdown
 
-    executor.start_polling(dp, skip_updates=True)
+
+def main():
+    args = parse_args()
+    if args.shards and args.shard is None:
+        run_sharded(args)
+        return
+    store = GameStore(DATABASE_PATH)
+    dp, shard, on_startup, on_shutdown = create_dispatcher(make_bot(), store, args.shard, args.shards)
+    if shard is not None:
+        run_worker(dp, shard, socket_path(args.socket_dir, shard.index), on_startup=on_startup,
+                   on_shutdown=on_shutdown)
+    elif args.webhook:
+        run_webhook(dp, host=args.host, port=args.port, path=args.path, url=args.url, secret=WEBHOOK_SECRET,
+                    on_startup=on_startup, on_shutdown=on_shutdown)
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,75 @@
+import logging
+import time
+
+from aiohttp import web
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+# the registry lives apart from the web stack, so the board engine and pool workers can record into it
+from instruments import REGISTRY, Metrics
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRICS_PATH = "/metrics"
+# keys of the middleware in aiogram's per-update data
+STARTED_KEY = "_metrics_started"
+HANDLER_KEY = "_metrics_handler"
+
+log = logging.getLogger(__name__)
+
+REGISTRY.describe("gobot_updates_total", "counter", "Messages received, by the FSM state of the user")
+REGISTRY.describe("gobot_handler_seconds", "histogram", "Time from receiving a message to its handler returning")
+
+
+class MetricsMiddleware(BaseMiddleware):
+    # times every message and callback handler and counts updates per FSM state
+    def __init__(self, metrics: Metrics = REGISTRY):
+        super().__init__()
+        self.metrics = metrics
+
+    async def _started(self, chat_id, user_id, data):
+        data[STARTED_KEY] = time.perf_counter()
+        state = await self.manager.dispatcher.storage.get_state(chat=chat_id, user=user_id)
+        self.metrics.inc("gobot_updates_total", state=state or "none")
+
+    def _finished(self, data):
+        started = data.get(STARTED_KEY, None)
+        if started is not None:
+            self.metrics.observe("gobot_handler_seconds", time.perf_counter() - started,
+                                 handler=data.get(HANDLER_KEY, "unhandled"))
+
+    @staticmethod
+    def _chosen(data):
+        data[HANDLER_KEY] = current_handler.get().__name__
+
+    async def on_pre_process_message(self, message, data):
+        await self._started(message.chat.id, message.from_user.id, data)
+
+    async def on_process_message(self, message, data):
+        self._chosen(data)
+
+    async def on_post_process_message(self, message, results, data):
+        self._finished(data)
+
+    async def on_pre_process_callback_query(self, query, data):
+        chat_id = query.message.chat.id if query.message is not None else query.from_user.id
+        await self._started(chat_id, query.from_user.id, data)
+
+    async def on_process_callback_query(self, query, data):
+        self._chosen(data)
+
+    async def on_post_process_callback_query(self, query, results, data):
+        self._finished(data)
+
+
+async def serve(host, port, metrics: Metrics = REGISTRY):
+    # a separate little server, so a scrape works in every mode and never goes through the webhook
+    async def scrape(_):
+        return web.Response(body=metrics.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, scrape)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("Metrics on http://%s:%d%s", host, port, METRICS_PATH)
+    return runner
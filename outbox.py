@@ -0,0 +1,226 @@
+import asyncio
+import io
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict
+
+from aiogram import Bot, types
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter, TelegramAPIError
+
+from metrics import REGISTRY
+
+MESSAGE_LIMIT = 4096
+# messages per second Telegram accepts from one bot
+GLOBAL_RATE = 30.0
+# seconds between checks on closing for chats still waiting on their buckets
+CLOSE_POLL = 0.1
+
+log = logging.getLogger(__name__)
+
+REGISTRY.describe("gobot_send_seconds", "histogram",
+                  "Latency of sendMessage, sendPhoto and editMessageText calls, failed ones included")
+REGISTRY.describe("gobot_send_failures_total", "counter", "Failed outgoing messages by reason")
+SEND_SECONDS = REGISTRY.histogram("gobot_send_seconds")
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def delay(self, now):
+        # seconds until a token is there, without taking it
+        tokens = self.tokens + (now - self.updated) * self.rate
+        return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class OutgoingMessage:
+    __slots__ = ('text', 'reply_markup', 'message_id', 'photo')
+
+    def __init__(self, text, reply_markup=None, message_id=None, photo=None):
+        self.text = text
+        self.reply_markup = reply_markup
+        # set for a new version of a message already sent
+        self.message_id = message_id
+        # a picture with png and file_id, the text is its caption
+        self.photo = photo
+
+
+class Outbox:
+    # Telegram allows about one message per second in a chat and 30 per second overall
+    def __init__(self, bot: Bot, workers=8, chat_rate=1.0, chat_burst=3, global_rate=GLOBAL_RATE,
+                 max_retries=5, max_buckets=10000):
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_buckets = max_buckets
+        self.pending: Dict[int, Deque[OutgoingMessage]] = dict()
+        self.buckets: Dict[int, TokenBucket] = dict()
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.ready = None
+        self._tasks = []
+
+    def start(self):
+        self.ready = asyncio.Queue()
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def close(self, timeout=10):
+        if self.ready is not None:
+            try:
+                await asyncio.wait_for(self._drained(), timeout)
+            except asyncio.TimeoutError:
+                log.warning("Dropping %d undelivered messages", self.depth())
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _drained(self):
+        # chats waiting for their bucket are off the ready queue until their timer puts them back
+        while self.pending:
+            await self.ready.join()
+            if self.pending:
+                await asyncio.sleep(CLOSE_POLL)
+
+    def depth(self):
+        return sum(len(queue) for queue in self.pending.values())
+
+    def send(self, chat_id, text, reply_markup=None):
+        self._enqueue(chat_id, OutgoingMessage(text, reply_markup))
+
+    def send_photo(self, chat_id, photo, caption=None, reply_markup=None):
+        self._enqueue(chat_id, OutgoingMessage(caption, reply_markup, photo=photo))
+
+    def edit(self, chat_id, message_id, text, reply_markup=None):
+        # only the newest version of a message is sent, it takes the place of one still waiting
+        message = OutgoingMessage(text, reply_markup, message_id)
+        queue = self.pending.get(chat_id, None)
+        if queue is not None:
+            for index, waiting in enumerate(queue):
+                if waiting.message_id == message_id:
+                    queue[index] = message
+                    return
+        self._enqueue(chat_id, message)
+
+    def _enqueue(self, chat_id, message: OutgoingMessage):
+        queue = self.pending.get(chat_id, None)
+        if queue is None:
+            queue = self.pending[chat_id] = deque()
+            self.ready.put_nowait(chat_id)
+        queue.append(message)
+
+    async def _worker(self):
+        while True:
+            chat_id = await self.ready.get()
+            try:
+                await self._drain(chat_id)
+            except Exception:
+                log.exception("Failed to deliver messages to %s", chat_id)
+                self.pending.pop(chat_id, None)
+            finally:
+                self.ready.task_done()
+
+    async def _drain(self, chat_id):
+        # only one worker drains a chat at a time, so its messages keep their order.
+        # A chat out of tokens goes back to the ready queue later, the worker moves on to the next chat
+        queue = self.pending[chat_id]
+        bucket = self.buckets.get(chat_id, None)
+        if bucket is None:
+            bucket = self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        while queue:
+            delay = bucket.delay(time.monotonic())
+            if delay > 0:
+                asyncio.get_event_loop().call_later(delay, self.ready.put_nowait, chat_id)
+                return
+            bucket.reserve(time.monotonic())
+            message = self._coalesce(queue)
+            await self._wait_for_global_token()
+            await self._deliver(chat_id, message)
+        del self.pending[chat_id]
+        if len(self.buckets) > self.max_buckets:
+            self._prune_buckets()
+
+    @staticmethod
+    def _coalesce(queue):
+        message = queue.popleft()
+        if message.message_id is not None or message.photo is not None:
+            return message
+        text = message.text
+        reply_markup = message.reply_markup
+        while queue:
+            following = queue[0]
+            if following.message_id is not None or following.photo is not None:
+                break
+            if reply_markup is not None and following.reply_markup is not None:
+                break
+            if len(text) + 1 + len(following.text) > MESSAGE_LIMIT:
+                break
+            queue.popleft()
+            text = f"{text}\n{following.text}"
+            reply_markup = reply_markup or following.reply_markup
+        return OutgoingMessage(text, reply_markup)
+
+    async def _wait_for_global_token(self):
+        # the bot's limit holds for every chat, waiting for it doesn't let another chat go first
+        delay = self.global_bucket.reserve(time.monotonic())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _deliver(self, chat_id, message: OutgoingMessage):
+        for _ in range(self.max_retries):
+            start = time.perf_counter()
+            try:
+                if message.photo is not None:
+                    await self._send_photo(chat_id, message)
+                elif message.message_id is None:
+                    await self.bot.send_message(chat_id, message.text, reply_markup=message.reply_markup)
+                else:
+                    await self.bot.edit_message_text(message.text, chat_id, message.message_id,
+                                                     reply_markup=message.reply_markup)
+                SEND_SECONDS.observe(time.perf_counter() - start)
+                return
+            except MessageNotModified:
+                SEND_SECONDS.observe(time.perf_counter() - start)
+                return
+            except RetryAfter as e:
+                SEND_SECONDS.observe(time.perf_counter() - start)
+                REGISTRY.inc("gobot_send_failures_total", reason="retry_after")
+                await asyncio.sleep(e.timeout)
+            except TelegramAPIError as e:
+                SEND_SECONDS.observe(time.perf_counter() - start)
+                REGISTRY.inc("gobot_send_failures_total", reason="api_error")
+                log.warning("Could not send a message to %s: %s", chat_id, e)
+                return
+        REGISTRY.inc("gobot_send_failures_total", reason="gave_up")
+        log.warning("Gave up sending a message to %s after %d attempts", chat_id, self.max_retries)
+
+    async def _send_photo(self, chat_id, message: OutgoingMessage):
+        photo = message.photo
+        if photo.file_id is not None:
+            await self.bot.send_photo(chat_id, photo.file_id, caption=message.text, reply_markup=message.reply_markup)
+            return
+        sent = await self.bot.send_photo(chat_id, types.InputFile(io.BytesIO(photo.png), filename="board.png"),
+                                         caption=message.text, reply_markup=message.reply_markup)
+        # Telegram keeps the upload, the same picture is sent by its id from now on
+        photo.file_id = sent.photo[-1].file_id
+
+    def _prune_buckets(self):
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, bucket in self.buckets.items() if bucket.is_full(now)]:
+            if chat_id not in self.pending:
+                del self.buckets[chat_id]
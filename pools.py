@@ -0,0 +1,41 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# forked workers would copy locks the bot's other threads may hold at that moment, the SQLite flush
+# and the board threads among them. The fork server starts them from a process without those threads
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+log = logging.getLogger(__name__)
+
+
+class ProcessPool:
+    # a process pool that is made again when it breaks, one worker killed by the OOM killer breaks the whole pool
+    def __init__(self, workers=None, name="process"):
+        self.workers = workers
+        self.name = name
+        self.executor = None
+
+    def start(self):
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(START_METHOD))
+
+    def shutdown(self, wait=True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+
+    async def run(self, func, *args):
+        # a call the broken pool lost is made once more on the new one, a second failure goes to the caller
+        loop = asyncio.get_event_loop()
+        executor = self.executor
+        try:
+            return await loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            # every call running on the pool fails at once, the first one here replaces it
+            if self.executor is executor:
+                log.warning("The %s pool broke, starting a new one", self.name)
+                executor.shutdown(wait=False)
+                self.start()
+            return await loop.run_in_executor(self.executor, func, *args)
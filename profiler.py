@@ -0,0 +1,162 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Awaitable, Callable, Counter, Tuple
+
+INTERVAL = 0.005
+MAX_SECONDS = 300
+TOP = 10
+# frames kept per allocation, more show who called the allocating line but make every allocation slower
+ALLOCATION_FRAMES = 1
+# leaf frames of threads with nothing to do, left out of the summary but kept in the stacks file
+IDLE = {("select", "selectors"), ("wait", "threading"), ("_worker", "concurrent.futures.thread")}
+
+log = logging.getLogger(__name__)
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return code.co_name, frame.f_globals.get("__name__", "?"), code.co_firstlineno
+
+
+def stack(frame):
+    frames = []
+    while frame is not None:
+        frames.append(frame_name(frame))
+        frame = frame.f_back
+    frames.reverse()
+    return tuple(frames)
+
+
+def label(name):
+    function, module, line = name
+    return f"{function} ({module}:{line})"
+
+
+class SamplingProfiler:
+    # samples every thread's stack from a thread of its own, so a handler holding up the event loop
+    # shows as well as the board threads
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.stacks: Counter[Tuple[str, tuple]] = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self.stacks[(names.get(ident, str(ident)), stack(frame))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        # the input of flamegraph.pl and speedscope, one line per stack with the thread as its root
+        lines = []
+        for (thread, frames), count in self.stacks.most_common():
+            names = [thread.replace(";", ":")] + [label(name).replace(";", ":") for name in frames]
+            lines.append(f"{';'.join(names)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def top(self, count=TOP):
+        # functions the samples were taken in, by share of samples
+        leaves = collections.Counter()
+        for (_, frames), samples in self.stacks.items():
+            if frames and frames[-1][:2] not in IDLE:
+                leaves[frames[-1]] += samples
+        return leaves.most_common(count)
+
+
+class AllocationTracker:
+    # what grew between the start and the end, only allocations made meanwhile are traced
+    def __init__(self, frames=ALLOCATION_FRAMES):
+        self.frames = frames
+        self.started_tracing = False
+        self.before = None
+
+    def start(self):
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start(self.frames)
+        self.before = tracemalloc.take_snapshot()
+
+    def stop(self, count=TOP):
+        after = tracemalloc.take_snapshot()
+        if self.started_tracing:
+            tracemalloc.stop()
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__),
+                   tracemalloc.Filter(False, __file__),
+                   tracemalloc.Filter(False, "<frozen importlib._bootstrap>")]
+        stats = after.filter_traces(filters).compare_to(self.before.filter_traces(filters), "lineno")
+        return [stat for stat in stats if stat.size_diff > 0][:count]
+
+
+class Profiling:
+    # one profile at a time, taken in the background while the bot goes on serving
+    def __init__(self, directory):
+        self.directory = directory
+        self.task = None
+
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self, seconds, report: Callable[[str, str], Awaitable]):
+        self.task = asyncio.ensure_future(self._run(seconds, report))
+
+    def close(self):
+        if self.running():
+            self.task.cancel()
+
+    async def _run(self, seconds, report):
+        try:
+            path, text = await self.profile(seconds)
+            await report(path, text)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Profiling failed")
+
+    async def profile(self, seconds):
+        profiler = SamplingProfiler()
+        allocations = AllocationTracker()
+        allocations.start()
+        profiler.start()
+        started = time.perf_counter()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.stop()
+            allocated = allocations.stop()
+        elapsed = time.perf_counter() - started
+        path = os.path.join(self.directory, f"gobot-profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, "w") as file:
+            file.write(profiler.collapsed())
+        return path, report(profiler, allocated, elapsed)
+
+
+def report(profiler: SamplingProfiler, allocated, elapsed):
+    lines = [f"{profiler.samples} samples in {elapsed:.1f} s, process {os.getpid()}", "Busiest functions:"]
+    total = max(1, profiler.samples)
+    for name, samples in profiler.top():
+        lines.append(f"{100 * samples / total:5.1f}% {label(name)}")
+    lines.append("Most memory allocated and still held:")
+    for stat in allocated:
+        frame = stat.traceback[0]
+        lines.append(f"{stat.size_diff / 1024:8.1f} KiB in {stat.count_diff:+} blocks "
+                     f"{os.path.basename(frame.filename)}:{frame.lineno}")
+    return "\n".join(lines)
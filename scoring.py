@@ -0,0 +1,160 @@
+import numpy as np
+
+try:
+    from scipy import ndimage
+except ImportError:
+    ndimage = None
+
+EMPTY = 0
+BLACK = 1
+WHITE = 2
+
+AREA = "area"
+TERRITORY = "territory"
+
+INFLUENCE_STEPS = 6
+# an empty region of this many points is treated as two eyes
+BIG_EYE = 7
+
+
+def label_regions(mask):
+    # 4-connected components of a boolean array, numbered from 1 like ndimage.label.
+    # Leading axes are a stack of boards, regions never connect across them.
+    if ndimage is not None:
+        structure = np.zeros((3,) * mask.ndim, dtype=bool)
+        centre = (1,) * (mask.ndim - 2)
+        structure[centre] = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
+        return ndimage.label(mask, structure)
+    n = mask.size
+    # every point points at the smallest flat index it has seen in its region, n is "not in a region"
+    labels = np.full(n + 1, n, dtype=np.intp)
+    labels[:n][mask.ravel()] = np.flatnonzero(mask)
+    padded = np.full(mask.shape[:-2] + (mask.shape[-2] + 2, mask.shape[-1] + 2), n, dtype=np.intp)
+    while True:
+        padded[..., 1:-1, 1:-1] = labels[:n].reshape(mask.shape)
+        smallest = np.minimum.reduce([padded[..., 1:-1, 1:-1], padded[..., :-2, 1:-1], padded[..., 2:, 1:-1],
+                                      padded[..., 1:-1, :-2], padded[..., 1:-1, 2:]])
+        smallest[~mask] = n
+        smallest = smallest.ravel()
+        # pointer jumping, so long snakes do not need one pass per point
+        smallest = labels[smallest]
+        smallest = labels[smallest]
+        if np.array_equal(smallest, labels[:n]):
+            break
+        labels[:n] = smallest
+    roots, inverse = np.unique(labels[:n], return_inverse=True)
+    inverse = inverse.reshape(mask.shape) + 1
+    inverse[~mask] = 0
+    count = len(roots) - (1 if roots[-1] == n else 0)
+    return inverse, count
+
+
+def neighbours(padded):
+    # the four neighbours of every board point, as views of the padded array
+    return (padded[..., :-2, 1:-1], padded[..., 2:, 1:-1], padded[..., 1:-1, :-2], padded[..., 1:-1, 2:])
+
+
+def regions(padded):
+    # labels of the empty regions and the colour owning each label, EMPTY when both or neither border it
+    board = padded[..., 1:-1, 1:-1]
+    empty = board == EMPTY
+    shifted = neighbours(padded)
+    touches_black = empty & np.logical_or.reduce([side == BLACK for side in shifted])
+    touches_white = empty & np.logical_or.reduce([side == WHITE for side in shifted])
+    labels, count = label_regions(empty)
+    black_regions = np.bincount(labels[touches_black], minlength=count + 1) > 0
+    white_regions = np.bincount(labels[touches_white], minlength=count + 1) > 0
+    owner = np.zeros(count + 1, dtype=np.int8)
+    owner[black_regions & ~white_regions] = BLACK
+    owner[white_regions & ~black_regions] = WHITE
+    owner[0] = EMPTY
+    return labels, owner
+
+
+def territory(padded):
+    # padded is the board with a one point border of any non-stone value around it
+    labels, owner = regions(padded)
+    return owner[labels]
+
+
+def score(padded, black_prisoners=0, white_prisoners=0, rules=TERRITORY, komi=0):
+    board = padded[1:-1, 1:-1]
+    owners = territory(padded)
+    black = int(np.count_nonzero(owners == BLACK))
+    white = int(np.count_nonzero(owners == WHITE))
+    if rules == AREA:
+        black += int(np.count_nonzero(board == BLACK))
+        white += int(np.count_nonzero(board == WHITE))
+    elif rules == TERRITORY:
+        black += black_prisoners
+        white += white_prisoners
+    else:
+        raise ValueError(f"Unknown scoring rules {rules}")
+    return black, white + komi
+
+
+def spread(source, steps=INFLUENCE_STEPS):
+    # works on a single board or a stack of boards in the last two axes
+    padded = np.zeros(source.shape[:-2] + (source.shape[-2] + 2, source.shape[-1] + 2), dtype=np.float32)
+    field = source
+    for _ in range(steps):
+        padded[..., 1:-1, 1:-1] = field
+        field = source + 0.25 * (padded[..., :-2, 1:-1] + padded[..., 2:, 1:-1] +
+                                 padded[..., 1:-1, :-2] + padded[..., 1:-1, 2:])
+    return field
+
+
+def grow(masks):
+    grown = masks.copy()
+    grown[..., 1:, :] |= masks[..., :-1, :]
+    grown[..., :-1, :] |= masks[..., 1:, :]
+    grown[..., :, 1:] |= masks[..., :, :-1]
+    grown[..., :, :-1] |= masks[..., :, 1:]
+    return grown
+
+
+def estimate_dead(padded, group_ids, rounds=3):
+    # group_ids numbers the stones of every group like Board.groups_array, returns the ids of the dead groups.
+    # A group is dead when it has less than two eyes, too few empty points around it under its own influence
+    # to make them, and the influence of the other stones around it favours the opponent.
+    # Dead groups are taken off and everything judged again, so spoiled eyes are counted once it is cleaned up.
+    board = padded[1:-1, 1:-1]
+    ids = np.unique(group_ids)
+    ids = ids[ids != 0]
+    if not len(ids):
+        return []
+    masks = group_ids[np.newaxis] == ids[:, np.newaxis, np.newaxis]
+    colors = board.ravel()[masks.reshape(len(ids), -1).argmax(axis=1)]
+    signs = np.where(colors == BLACK, 1, -1).astype(np.float32)
+    own_fields = spread(masks * signs[:, np.newaxis, np.newaxis])
+    around = grow(masks) & ~masks
+    ring_sizes = np.maximum(around.sum(axis=(1, 2)), 1)
+    stones = (board == BLACK).astype(np.float32) - (board == WHITE)
+    dead = np.zeros(len(ids), dtype=bool)
+    for _ in range(rounds):
+        dead_stones = masks[dead].any(axis=0)
+        cleared = padded.copy()
+        cleared[1:-1, 1:-1][dead_stones] = EMPTY
+        field = spread(np.where(dead_stones, 0, stones))
+        others = field - own_fields * ~dead[:, np.newaxis, np.newaxis]
+        strength = signs * (others * around).sum(axis=(1, 2)) / ring_sizes
+
+        labels, owner = regions(cleared)
+        empty = cleared[1:-1, 1:-1] == EMPTY
+        group_index, rows, columns = np.nonzero(around & empty)
+        pairs = np.unique(group_index * len(owner) + labels[rows, columns])
+        group_index, region = np.divmod(pairs, len(owner))
+        sizes = np.bincount(labels.ravel(), minlength=len(owner))
+        eye_values = np.where(sizes[region] >= BIG_EYE, 2, 1) * (owner[region] == colors[group_index])
+        eyes = np.bincount(group_index, weights=eye_values, minlength=len(ids))
+        black_space = np.bincount(labels[empty & (field > 0)], minlength=len(owner))
+        white_space = np.bincount(labels[empty & (field < 0)], minlength=len(owner))
+        is_black = colors[group_index] == BLACK
+        space = np.bincount(group_index, weights=np.where(is_black, black_space[region], white_space[region]),
+                            minlength=len(ids))
+
+        found = (eyes < 2) & (space < BIG_EYE) & (strength < 0)
+        if np.array_equal(found, dead):
+            break
+        dead = found
+    return [int(group_id) for group_id in ids[dead]]
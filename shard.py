@@ -0,0 +1,196 @@
+import asyncio
+import functools
+import logging
+import os
+import zlib
+
+from aiohttp import ClientConnectionError, ClientSession, UnixConnector, web
+from aiogram import Bot, Dispatcher, types
+from aiogram.dispatcher.webhook import WebhookRequestHandler
+from aiogram.utils.executor import Executor
+
+from locks import GameLocks
+from webhook import SECRET_HEADER
+
+# worker 0 is the lobby, it keeps the player names and open games and answers every menu.
+# Workers 1..N own the live games, a game belongs to the worker its name hashes to.
+LOBBY = 0
+SHARD_KEY = "GOBOT_SHARD"
+FORWARD_PATH = "/update"
+
+log = logging.getLogger(__name__)
+
+
+def shard_of(game_name, shards):
+    return 1 + zlib.crc32(game_name.encode()) % shards
+
+
+def socket_path(directory, index):
+    return os.path.join(directory, f"gobot-{index}.sock")
+
+
+def update_user(data):
+    # the private chat the update came from, updates without one go to the lobby
+    for kind in ("message", "edited_message"):
+        if kind in data:
+            return data[kind]["chat"]["id"]
+    if "callback_query" in data:
+        return data["callback_query"]["from"]["id"]
+    return None
+
+
+class Shard:
+    def __init__(self, index, shards, registry, store, game_states):
+        self.index = index
+        self.shards = shards
+        self.registry = registry
+        self.store = store
+        # FSM states in which the user's updates go to the worker of their current game
+        self.game_states = game_states
+
+    def owns(self, game_name):
+        return shard_of(game_name, self.shards) == self.index
+
+    async def current_game(self, dispatcher: Dispatcher, user):
+        if user is None:
+            return None
+        state = await dispatcher.storage.get_state(chat=user, user=user)
+        if state not in self.game_states:
+            return None
+        return (await dispatcher.storage.get_data(chat=user, user=user)).get('current_game', None)
+
+    def owner(self, game_name):
+        return LOBBY if game_name is None else shard_of(game_name, self.shards)
+
+
+class ShardRequestHandler(WebhookRequestHandler):
+    # handles an update the router forwarded, or names the worker it belongs to if the user has moved on
+    async def post(self):
+        shard: Shard = self.request.app[SHARD_KEY]
+        dispatcher = self.get_dispatcher()
+        data = await self.request.json()
+        user = update_user(data)
+        # another worker may have changed the user's state since this one cached it
+        if user is not None:
+            dispatcher.storage.forget(user, user)
+        game_name = await shard.current_game(dispatcher, user)
+        owner = shard.owner(game_name)
+        if owner != shard.index:
+            return web.json_response({"handled": False, "owner": owner})
+        if game_name is not None:
+            await shard.registry.adopt(game_name)
+        elif user is not None:
+            await shard.registry.refresh_player(user)
+        try:
+            await dispatcher.updates_handler.notify(types.Update(**data))
+        except Exception:
+            log.exception("Update handling failed")
+        # the next update of this user may go to another worker, it has to find the state and a new game
+        # in the database. Moves stay batched, only this worker reads the boards of its games
+        await shard.store.flush_async(shared=True)
+        game_name = await shard.current_game(dispatcher, user)
+        if user is not None:
+            dispatcher.storage.forget(user, user)
+        return web.json_response({"handled": True, "owner": shard.owner(game_name)})
+
+
+def run_worker(dp: Dispatcher, shard: Shard, path, on_startup=None, on_shutdown=None):
+    if os.path.exists(path):
+        os.remove(path)
+    app = web.Application()
+    app[SHARD_KEY] = shard
+    runner = Executor(dp, skip_updates=False)
+    if on_startup is not None:
+        runner.on_startup(on_startup, polling=False)
+    if on_shutdown is not None:
+        runner.on_shutdown(on_shutdown, polling=False)
+    runner.set_webhook(webhook_path=FORWARD_PATH, request_handler=ShardRequestHandler, web_app=app)
+    try:
+        runner.run_app(path=path)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class Router:
+    # receives the webhook and passes every update on to the worker owning it, one update per user at a time
+    def __init__(self, bot: Bot, sockets, secret=None):
+        self.bot = bot
+        self.sockets = sockets
+        self.secret = secret
+        self.sessions = []
+        # the worker of users who are in a game, everybody else is in the lobby
+        self.routes = dict()
+        self.users = GameLocks()
+        self.tasks = set()
+
+    async def start(self, _=None):
+        self.sessions = [ClientSession(connector=UnixConnector(path=path)) for path in self.sockets]
+        for session in self.sessions:
+            await wait_for_worker(session)
+
+    async def close(self, _=None):
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        for session in self.sessions:
+            await session.close()
+        await self.bot.close()
+
+    async def receive(self, request: web.Request):
+        if self.secret is not None and request.headers.get(SECRET_HEADER) != self.secret:
+            raise web.HTTPForbidden()
+        data = await request.json()
+        task = asyncio.ensure_future(self.forward(update_user(data), data))
+        self.tasks.add(task)
+        task.add_done_callback(functools.partial(_forget_task, self.tasks))
+        return web.Response(text='ok')
+
+    async def forward(self, user, data):
+        async with self.users.hold(user):
+            owner = self.routes.get(user, LOBBY)
+            # a stale route costs one extra hop, the worker says where the user is now
+            for _ in range(len(self.sessions)):
+                async with self.sessions[owner].post("http://worker" + FORWARD_PATH, json=data) as response:
+                    response.raise_for_status()
+                    answer = await response.json()
+                if answer["owner"] == LOBBY:
+                    self.routes.pop(user, None)
+                else:
+                    self.routes[user] = answer["owner"]
+                if answer["handled"]:
+                    return
+                owner = answer["owner"]
+            log.error("No worker took the update of user %s", user)
+
+
+async def wait_for_worker(session, timeout=30):
+    # workers bind their sockets after loading their games
+    deadline = asyncio.get_event_loop().time() + timeout
+    while True:
+        try:
+            async with session.get("http://worker" + FORWARD_PATH):
+                return
+        except (ClientConnectionError, FileNotFoundError):
+            if asyncio.get_event_loop().time() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+def _forget_task(tasks, task):
+    tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("Forwarding an update failed", exc_info=task.exception())
+
+
+def run_router(router: Router, *, host, port, path, url=None):
+    app = web.Application()
+    app.router.add_post(path, router.receive)
+
+    async def register_webhook(_):
+        if url is not None:
+            await router.bot.set_webhook(url.rstrip("/") + path, secret_token=router.secret)
+
+    app.on_startup.append(router.start)
+    app.on_startup.append(register_webhook)
+    app.on_shutdown.append(router.close)
+    web.run_app(app, host=host, port=port)
@@ -0,0 +1,394 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import typing
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+from board import Board, MoveLog
+from games import CHAT_CAPACITY, Chat, Game, LiveGame, turn
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS open_games (
+    name TEXT PRIMARY KEY,
+    creator TEXT NOT NULL,
+    creator_id INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS live_games (
+    name TEXT PRIMARY KEY,
+    creator TEXT NOT NULL,
+    creator_id INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    opponent TEXT NOT NULL,
+    opponent_id INTEGER NOT NULL,
+    board BLOB NOT NULL,
+    log BLOB,
+    turn INTEGER
+);
+CREATE TABLE IF NOT EXISTS move_logs (
+    game TEXT NOT NULL,
+    first INTEGER NOT NULL,
+    chunk BLOB NOT NULL,
+    PRIMARY KEY (game, first)
+);
+CREATE TABLE IF NOT EXISTS chat_messages (
+    game TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    PRIMARY KEY (game, seq)
+);
+CREATE TABLE IF NOT EXISTS fsm (
+    chat TEXT NOT NULL,
+    user TEXT NOT NULL,
+    record TEXT NOT NULL,
+    PRIMARY KEY (chat, user)
+);
+"""
+
+
+class GameStore:
+    def __init__(self, path, flush_interval=1.0, batch_size=500):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(live_games)")]
+        if "log" not in columns:
+            self.connection.execute("ALTER TABLE live_games ADD COLUMN log BLOB")
+        # the colour to move and 0 once the game has ended, so turns are found without loading boards
+        if "turn" not in columns:
+            self.connection.execute("ALTER TABLE live_games ADD COLUMN turn INTEGER")
+        rows = self.connection.execute("SELECT name, board FROM live_games WHERE turn IS NULL").fetchall()
+        self.connection.executemany("UPDATE live_games SET turn = ? WHERE name = ?",
+                                    [(turn(Board.from_bytes(board)), name) for name, board in rows])
+        self.lock = threading.Lock()
+        # pending writes keyed by primary key, None means delete
+        self.pending_open: typing.Dict[str, typing.Optional[Game]] = dict()
+        self.pending_live: typing.Dict[str, LiveGame] = dict()
+        self.pending_fsm: typing.Dict[typing.Tuple[str, str], typing.Optional[str]] = dict()
+        # finished games, their rows, moves and chat go before anything is written.
+        # Kept apart from pending_live, a new game of the same name must not take the place of the delete
+        self.live_deletes: typing.Set[str] = set()
+        # live games started since they were last written, other processes look them up
+        self.shared_live: typing.Set[str] = set()
+        # games whose boards are being changed off the event loop, written on a later flush
+        self.busy: typing.Set[str] = set()
+        # games stored before they had a move log, their boards keep the positions the log doesn't have
+        self.full_history: typing.Set[str] = set()
+        self.flush_needed = asyncio.Event()
+        # batches are taken and written one at a time, so an older one never lands after a newer one
+        self.writing = asyncio.Lock()
+        self._task = None
+
+    def pending(self):
+        return len(self.pending_open) + len(self.pending_live) + len(self.pending_fsm) + len(self.live_deletes)
+
+    def is_pending(self, game_name):
+        return game_name in self.pending_live or game_name in self.busy
+
+    def _mark(self):
+        if self.pending() >= self.batch_size:
+            self.flush_needed.set()
+
+    def save_open_game(self, game: Game):
+        self.pending_open[game.name] = game
+        self._mark()
+
+    def delete_open_game(self, game_name):
+        self.pending_open[game_name] = None
+        self._mark()
+
+    def save_live_game(self, live_game: LiveGame, started=False):
+        self.pending_live[live_game.game.name] = live_game
+        if started:
+            self.shared_live.add(live_game.game.name)
+        self._mark()
+
+    def delete_live_game(self, game_name):
+        self.pending_live.pop(game_name, None)
+        self.shared_live.discard(game_name)
+        self.full_history.discard(game_name)
+        self.live_deletes.add(game_name)
+        self._mark()
+
+    def save_fsm(self, chat, user, record):
+        self.pending_fsm[(chat, user)] = None if record is None else json.dumps(record)
+        self._mark()
+
+    def load_fsm(self, chat, user):
+        if (chat, user) in self.pending_fsm:
+            record = self.pending_fsm[(chat, user)]
+        else:
+            with self.lock:
+                row = self.connection.execute("SELECT record FROM fsm WHERE chat = ? AND user = ?",
+                                              (chat, user)).fetchone()
+            record = None if row is None else row[0]
+        return None if record is None else json.loads(record)
+
+    async def load_fsm_async(self, chat, user):
+        # a flush may hold the lock for a whole transaction, the event loop doesn't wait for it
+        if (chat, user) in self.pending_fsm:
+            return self.load_fsm(chat, user)
+        return await asyncio.get_event_loop().run_in_executor(None, self.load_fsm, chat, user)
+
+    def load_open_games(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT creator, creator_id, name, size FROM open_games").fetchall()
+        return [Game(*row) for row in rows]
+
+    @staticmethod
+    def _live_game(row):
+        creator, creator_id, name, size, opponent, opponent_id, to_move = row
+        live_game = LiveGame(Game(creator, creator_id, name, size), opponent, opponent_id)
+        live_game.dehydrate()
+        live_game.turn = to_move
+        return live_game
+
+    def load_live_games(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT creator, creator_id, name, size, opponent, opponent_id, turn "
+                                           "FROM live_games").fetchall()
+        return [self._live_game(row) for row in rows]
+
+    def load_live_game(self, name):
+        with self.lock:
+            row = self.connection.execute("SELECT creator, creator_id, name, size, opponent, opponent_id, turn "
+                                          "FROM live_games WHERE name = ?", (name,)).fetchone()
+        return None if row is None else self._live_game(row)
+
+    def load_turns(self, names):
+        with self.lock:
+            rows = self.connection.execute(f"SELECT name, turn FROM live_games WHERE name IN "
+                                           f"({', '.join('?' * len(names))})", names).fetchall()
+        return dict(rows)
+
+    def opponent_turns(self, opponent_id):
+        with self.lock:
+            rows = self.connection.execute("SELECT name FROM live_games WHERE opponent_id = ? AND turn = ?",
+                                           (opponent_id, Board.WHITE)).fetchall()
+        return [row[0] for row in rows]
+
+    def has_live_game(self, name):
+        if name in self.pending_live:
+            return True
+        if name in self.live_deletes:
+            return False
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM live_games WHERE name = ?", (name,)).fetchone()
+        return row is not None
+
+    def load_board(self, live_game: LiveGame):
+        # the board and chat of a game, runs in the executor and leaves setting them to the event loop
+        name = live_game.game.name
+        with self.lock:
+            row = self.connection.execute("SELECT board, log FROM live_games WHERE name = ?", (name,)).fetchone()
+            chunks = self.connection.execute("SELECT first, chunk FROM move_logs WHERE game = ? ORDER BY first",
+                                             (name,)).fetchall()
+            # only the newest messages, older ones stay in the table until somebody pages back to them
+            messages = self.connection.execute("SELECT seq, message FROM chat_messages WHERE game = ? "
+                                               "ORDER BY seq DESC LIMIT ?", (name, CHAT_CAPACITY)).fetchall()
+        board = Board(live_game.game.size) if row is None else Board.from_bytes(row[0])
+        if row is not None:
+            self._load_log(board, name, row[1], chunks)
+        return board, Chat([message for _, message in reversed(messages)], messages[0][0] + 1 if messages else 0)
+
+    def _load_log(self, board: Board, name, whole_log, chunks):
+        # rows written before move_logs have the whole log, it moves to the chunks on the next write
+        log = MoveLog(board.size) if whole_log is None else MoveLog.from_bytes(whole_log)
+        for first, chunk in chunks:
+            part = MoveLog.from_bytes(chunk)
+            part.start = first
+            log.extend(part)
+        log.saved = 0 if whole_log is not None else len(log)
+        board.log = log
+        # the board is stored without the positions it has been in, the log has them
+        history = {0}
+        history.update(log.hashes)
+        if board.history - history:
+            self.full_history.add(name)
+        board.history.update(history)
+
+    def load_chat(self, game_name, first, last):
+        with self.lock:
+            return self.connection.execute("SELECT seq, message FROM chat_messages WHERE game = ? AND seq >= ? "
+                                           "AND seq < ? ORDER BY seq", (game_name, first, last)).fetchall()
+
+    def _take_pending(self, shared=False):
+        # shared takes only what other processes read next: the FSM records, the games started and the deletes.
+        # Moves and chat of a game stay batched, nobody but the worker owning the game reads them
+        if shared:
+            pending_open = dict()
+            pending_live = {name: self.pending_live.pop(name) for name in self.shared_live if name in self.pending_live}
+        else:
+            pending_open, self.pending_open = self.pending_open, dict()
+            pending_live, self.pending_live = self.pending_live, dict()
+        open_rows = []
+        open_deletes = []
+        for name, game in pending_open.items():
+            if game is None:
+                open_deletes.append((name,))
+            else:
+                open_rows.append((game.name, game.creator, game.creator_id, game.size))
+        live_rows = []
+        log_rows = []
+        chat_rows = []
+        for name, live_game in pending_live.items():
+            if name in self.busy:
+                # written on a later flush
+                self.pending_live[name] = live_game
+                continue
+            if not live_game.is_hydrated():
+                continue
+            game = live_game.game
+            board = live_game.board
+            live_rows.append((name, game.creator, game.creator_id, game.size, live_game.opponent,
+                              live_game.opponent_id, board.to_bytes(history=name in self.full_history), turn(board)))
+            # only the moves since the last write, the ones before are in the table already
+            unsaved = board.log.take_unsaved()
+            if len(unsaved):
+                log_rows.append((name, unsaved.start, unsaved.to_bytes()))
+            chat_rows.extend((name, seq, message) for seq, message in live_game.chat.take_unsaved())
+        fsm_rows = []
+        fsm_deletes = []
+        for (chat, user), record in self.pending_fsm.items():
+            if record is None:
+                fsm_deletes.append((chat, user))
+            else:
+                fsm_rows.append((chat, user, record))
+        live_deletes = [(name,) for name in self.live_deletes]
+        self.shared_live = {name for name in self.shared_live if name in self.pending_live}
+        self.pending_fsm = dict()
+        self.live_deletes = set()
+        return open_rows, open_deletes, live_rows, live_deletes, log_rows, chat_rows, fsm_rows, fsm_deletes
+
+    def _write(self, batch):
+        open_rows, open_deletes, live_rows, live_deletes, log_rows, chat_rows, fsm_rows, fsm_deletes = batch
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN")
+            try:
+                cursor.executemany("DELETE FROM open_games WHERE name = ?", open_deletes)
+                cursor.executemany("INSERT OR REPLACE INTO open_games VALUES (?, ?, ?, ?)", open_rows)
+                cursor.executemany("DELETE FROM live_games WHERE name = ?", live_deletes)
+                cursor.executemany("DELETE FROM move_logs WHERE game = ?", live_deletes)
+                cursor.executemany("DELETE FROM chat_messages WHERE game = ?", live_deletes)
+                cursor.executemany("INSERT OR REPLACE INTO live_games (name, creator, creator_id, size, opponent, "
+                                   "opponent_id, board, turn) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", live_rows)
+                cursor.executemany("INSERT OR REPLACE INTO move_logs VALUES (?, ?, ?)", log_rows)
+                cursor.executemany("INSERT OR REPLACE INTO chat_messages VALUES (?, ?, ?)", chat_rows)
+                cursor.executemany("DELETE FROM fsm WHERE chat = ? AND user = ?", fsm_deletes)
+                cursor.executemany("INSERT OR REPLACE INTO fsm VALUES (?, ?, ?)", fsm_rows)
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+
+    def flush(self):
+        if self.pending():
+            self._write(self._take_pending())
+
+    async def flush_async(self, shared=False):
+        waiting = (self.pending_fsm or self.shared_live or self.live_deletes) if shared else self.pending()
+        if not waiting:
+            return
+        async with self.writing:
+            batch = self._take_pending(shared)
+            await asyncio.get_event_loop().run_in_executor(None, self._write, batch)
+
+    async def run(self, registry=None, max_idle=600):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_needed.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_needed.clear()
+            await self.flush_async()
+            if registry is not None:
+                registry.evict_idle(max_idle)
+
+    def start(self, registry=None, max_idle=600):
+        self._task = asyncio.ensure_future(self.run(registry, max_idle))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.flush()
+        with self.lock:
+            self.connection.close()
+
+
+class SQLiteStorage(MemoryStorage):
+    def __init__(self, store: GameStore):
+        super().__init__()
+        self.store = store
+
+    async def _load(self, chat, user):
+        # reads a record missing from memory, every method looking one up awaits this first
+        chat_id, user_id = map(str, self.check_address(chat=chat, user=user))
+        if chat_id in self.data and user_id in self.data[chat_id]:
+            return
+        record = await self.store.load_fsm_async(chat_id, user_id)
+        # a handler may have set the record while it was being read, that one is newer
+        if record is not None and user_id not in self.data.get(chat_id, {}):
+            self.data.setdefault(chat_id, {})[user_id] = record
+
+    def forget(self, chat, user):
+        # drops the cached record, the next read comes from the database
+        chat_id, user_id = map(str, self.check_address(chat=chat, user=user))
+        records = self.data.get(chat_id, None)
+        if records is not None:
+            records.pop(user_id, None)
+            if not records:
+                del self.data[chat_id]
+
+    def _persist(self, chat, user):
+        chat_id, user_id = map(str, self.check_address(chat=chat, user=user))
+        record = self.data.get(chat_id, {}).get(user_id, None)
+        self.store.save_fsm(chat_id, user_id, record)
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        await self._load(chat, user)
+        return await super().get_state(chat=chat, user=user, default=default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        await self._load(chat, user)
+        return await super().get_data(chat=chat, user=user, default=default)
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        await self._load(chat, user)
+        return await super().get_bucket(chat=chat, user=user, default=default)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        await self._load(chat, user)
+        await super().update_data(chat=chat, user=user, data=data, **kwargs)
+        self._persist(chat, user)
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        await self._load(chat, user)
+        await super().set_state(chat=chat, user=user, state=state)
+        self._persist(chat, user)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        await self._load(chat, user)
+        await super().set_data(chat=chat, user=user, data=data)
+        self._persist(chat, user)
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        await self._load(chat, user)
+        await super().set_bucket(chat=chat, user=user, bucket=bucket)
+        self._persist(chat, user)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        await self._load(chat, user)
+        await super().update_bucket(chat=chat, user=user, bucket=bucket, **kwargs)
+        self._persist(chat, user)
+
+    async def close(self):
+        await super().close()
+        await self.store.close()
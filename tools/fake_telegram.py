@@ -0,0 +1,213 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import time
+from string import ascii_lowercase
+
+from aiohttp import ClientConnectionError, ClientSession, web
+
+# a stand-in for the Bot API: answers the bot's requests and pushes synthetic updates to its webhook.
+# point the bot at it with TELEGRAM_API_SERVER = "http://127.0.0.1:8081" in config.py
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# every script ends with /guide, the answer to it means the bot got through all updates of that user
+GUIDE_ANSWER = "Welcome to the guide"
+
+
+class Answer:
+    # in a script, waits for a line of the bot starting with one of the prefixes before sending on,
+    # the way a player reads the prompt before typing. The bot handles updates concurrently,
+    # a user typing ahead of its answers could overtake the state they set
+    def __init__(self, *prefixes):
+        self.prefixes = prefixes
+
+
+# the computer's move or why the move was refused
+MOVE_ANSWER = Answer("GoBot ", "There is already", "It's not your turn", "This move", "You are trying",
+                     "Move should be", "The game is")
+
+
+class FakeTelegram:
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.message_ids = itertools.count(1)
+        self.update_ids = itertools.count(1)
+        self.sent = 0
+        self.webhook_url = None
+        self.webhook_set = asyncio.Event()
+        self.guided = 0
+        self.all_guided = asyncio.Event()
+        self.users = 0
+        self.lines = collections.defaultdict(asyncio.Queue)
+
+    async def answer(self, user_id, answer: Answer):
+        lines = self.lines[user_id]
+        while not (await lines.get()).startswith(answer.prefixes):
+            pass
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.api)
+        return app
+
+    async def api(self, request: web.Request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "GoBot", "username": "gobot"}
+        elif method == "setWebhook":
+            self.webhook_url = params.get("url")
+            self.webhook_set.set()
+            result = True
+        elif method in ("deleteWebhook", "setMyCommands"):
+            result = True
+        elif method == "getUpdates":
+            result = []
+        elif method == "sendMessage":
+            self.sent += 1
+            if GUIDE_ANSWER in params.get("text", ""):
+                self.guided += 1
+                if self.guided == self.users:
+                    self.all_guided.set()
+            for line in params.get("text", "").splitlines():
+                self.lines[int(params["chat_id"])].put_nowait(line.strip())
+            if self.verbose:
+                print(f"-> {params.get('chat_id')}: {params.get('text')}")
+            result = self.message(int(params["chat_id"]), params.get("text", ""))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def message(self, chat_id, text):
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text,
+        }
+
+    def update(self, user_id, text):
+        message = self.message(user_id, text)
+        message["from"] = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return {"update_id": next(self.update_ids), "message": message}
+
+
+async def wait_for_webhook(session, webhook, timeout=10):
+    # the bot registers its webhook before its server starts listening
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with session.get(webhook):
+                return
+        except ClientConnectionError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+def menus(user_id, moves):
+    return ["/start", f"player{user_id}", "/list", "/list_my_live", "/guide"]
+
+
+def self_play(user_id, moves):
+    # a 19x19 game against oneself, so every move is a game update
+    game = f"game{user_id}"
+    points = [f"{ascii_lowercase[i % 19]}{(i // 19 + i * 7) % 19}" for i in range(moves)]
+    return ["/start", f"player{user_id}", "/new_game", game, "Y", "19", "Human", "/join", game,
+            "/play", game, "/make_move", *points, "/guide"]
+
+
+def bot_play(user_id, moves):
+    # a 9x9 game against the computer, every message waits for its answer like a player would
+    game = f"game{user_id}"
+    points = [f"{ascii_lowercase[i % 9]}{(i // 9 + i * 4) % 9}" for i in range(moves)]
+    script = ["/start", Answer("Please Enter your username"), f"player{user_id}", Answer("OK, "),
+              "/new_game", Answer("Enter the name of the game"), game, Answer("The game name is set"),
+              "Y", Answer("OK, now enter the size"), "9", Answer("Do you want to play"),
+              "Computer", Answer("The game against"), "/play", Answer("Enter the name of the game you want to play"),
+              game, Answer("/make_move"), "/make_move", Answer("Now make a move")]
+    for point in points:
+        script += [point, MOVE_ANSWER]
+    return script + ["/guide"]
+
+
+SCRIPTS = {"menus": menus, "self_play": self_play, "bot_play": bot_play}
+
+
+async def push_updates(fake: FakeTelegram, webhook, secret, users, script, first_user=1000):
+    fake.users = users
+    headers = {SECRET_HEADER: secret} if secret is not None else {}
+    latencies = []
+    async with ClientSession() as session:
+        await wait_for_webhook(session, webhook)
+        async def user_session(user_id):
+            for text in script(user_id):
+                if isinstance(text, Answer):
+                    await asyncio.wait_for(fake.answer(user_id, text), 60)
+                    continue
+                start = time.perf_counter()
+                async with session.post(webhook, json=fake.update(user_id, text), headers=headers) as response:
+                    response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user_session(first_user + i) for i in range(users)))
+        elapsed = time.perf_counter() - start
+        await fake.all_guided.wait()
+        handled = time.perf_counter() - start
+    latencies.sort()
+    print(f"{len(latencies)} updates in {elapsed:.2f} s, ack p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
+    print(f"all handled in {handled:.2f} s, {len(latencies) / handled:.0f} updates/s")
+    return len(latencies) / handled
+
+
+async def run(args):
+    fake = FakeTelegram(args.verbose)
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    await web.TCPSite(runner, args.api_host, args.api_port).start()
+
+    def script(user_id):
+        return SCRIPTS[args.script](user_id, args.moves)
+
+    if args.users:
+        webhook = args.webhook
+        if webhook is None:
+            await fake.webhook_set.wait()
+            webhook = fake.webhook_url
+        await push_updates(fake, webhook, args.secret, args.users, script, args.first_user)
+        await asyncio.sleep(args.linger)
+        print(f"bot sent {fake.sent} messages")
+    else:
+        while True:
+            await asyncio.sleep(3600)
+    await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server and webhook update sender")
+    parser.add_argument("--api-host", default="127.0.0.1")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--webhook", help="webhook url to push to, by default the one the bot registers")
+    parser.add_argument("--secret")
+    parser.add_argument("--users", type=int, default=10, help="simulated users, 0 only serves the api")
+    parser.add_argument("--script", choices=sorted(SCRIPTS), default="menus")
+    parser.add_argument("--moves", type=int, default=50, help="moves per user in the self_play and bot_play scripts")
+    parser.add_argument("--first-user", type=int, default=1000,
+                        help="id of the first simulated user, change it to start over on the same database")
+    parser.add_argument("--linger", type=float, default=2.0, help="seconds to keep answering the bot after sending")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
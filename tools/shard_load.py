@@ -0,0 +1,64 @@
+import argparse
+import asyncio
+import os
+import signal
+import sys
+
+from aiohttp import web
+
+from fake_telegram import FakeTelegram, SCRIPTS, push_updates
+
+# runs the bot against the fake Bot API with 0 (a single process), 1, 2, ... game workers and the same load each time.
+# config.py needs TELEGRAM_API_SERVER = "http://127.0.0.1:8081"
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+
+
+async def measure(args, shards, first_user):
+    fake = FakeTelegram()
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.api_port).start()
+    command = [sys.executable, MAIN, "--webhook", "--port", str(args.port), "--url", f"http://127.0.0.1:{args.port}"]
+    if shards:
+        command += ["--shards", str(shards)]
+    bot = await asyncio.create_subprocess_exec(*command, cwd=os.path.dirname(MAIN),
+                                               stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    try:
+        await fake.webhook_set.wait()
+        return await push_updates(fake, fake.webhook_url, args.secret, args.users,
+                                  lambda user_id: SCRIPTS[args.script](user_id, args.moves), first_user)
+    finally:
+        bot.send_signal(signal.SIGINT)
+        await bot.wait()
+        await runner.cleanup()
+
+
+async def run(args):
+    results = []
+    for run_index, shards in enumerate(args.shards):
+        print(f"--- {shards} game workers" if shards else "--- single process")
+        # new users and game names every run, the database is shared
+        first_user = args.first_user + run_index * args.users
+        results.append((shards, await measure(args, shards, first_user)))
+    print()
+    for shards, rate in results:
+        print(f"{shards:3} workers {rate:8.0f} updates/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bot throughput with different numbers of game workers")
+    parser.add_argument("--shards", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--script", choices=sorted(SCRIPTS), default="self_play")
+    parser.add_argument("--moves", type=int, default=50)
+    parser.add_argument("--first-user", type=int, default=100000)
+    parser.add_argument("--secret")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--api-port", type=int, default=8081)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import asyncio
+import functools
+import logging
+
+from aiohttp import web
+from aiogram import Dispatcher
+from aiogram.dispatcher.webhook import WebhookRequestHandler
+from aiogram.utils.executor import Executor
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+WEBHOOK_SECRET_KEY = "GOBOT_WEBHOOK_SECRET"
+UPDATE_TASKS_KEY = "GOBOT_UPDATE_TASKS"
+
+log = logging.getLogger(__name__)
+
+
+class QuickAckRequestHandler(WebhookRequestHandler):
+    # answers Telegram as soon as the update is parsed, handlers run as separate tasks
+    async def post(self):
+        self.validate_ip()
+        secret = self.request.app[WEBHOOK_SECRET_KEY]
+        if secret is not None and self.request.headers.get(SECRET_HEADER) != secret:
+            raise web.HTTPForbidden()
+        dispatcher = self.get_dispatcher()
+        update = await self.parse_update(dispatcher.bot)
+        task = asyncio.ensure_future(dispatcher.updates_handler.notify(update))
+        tasks = self.request.app[UPDATE_TASKS_KEY]
+        tasks.add(task)
+        task.add_done_callback(functools.partial(_forget_task, tasks))
+        return web.Response(text='ok')
+
+
+def _forget_task(tasks, task):
+    tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("Update handling failed", exc_info=task.exception())
+
+
+def run_webhook(dp: Dispatcher, *, host, port, path, url=None, secret=None, on_startup=None, on_shutdown=None):
+    app = web.Application()
+    app[WEBHOOK_SECRET_KEY] = secret
+    app[UPDATE_TASKS_KEY] = set()
+
+    async def register_webhook(dispatcher: Dispatcher):
+        if url is not None:
+            await dispatcher.bot.set_webhook(url.rstrip("/") + path, secret_token=secret)
+
+    async def finish_updates(_):
+        tasks = app[UPDATE_TASKS_KEY]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    app.on_shutdown.append(finish_updates)
+
+    runner = Executor(dp, skip_updates=False)
+    if on_startup is not None:
+        runner.on_startup(on_startup, polling=False)
+    runner.on_startup(register_webhook, polling=False)
+    if on_shutdown is not None:
+        runner.on_shutdown(on_shutdown, polling=False)
+    runner.set_webhook(webhook_path=path, request_handler=QuickAckRequestHandler, web_app=app)
+    runner.run_app(host=host, port=port)